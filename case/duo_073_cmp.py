@@ -5,6 +5,8 @@ from skimage import io
 from skimage import measure
 import glob
 
+from particle_vtools.Comparison import surface_metrics
+
 save_fig = False
 num_frames = 49
 move_camera = False
@@ -34,6 +36,7 @@ def cube2mesh(cube, threshold=0):
 t = 0
 mesh_og = cube2mesh(cube_og, threshold=0)
 mesh_dn = cube2mesh(cube_dn, threshold=0)
+print("Original vs down sampled:", surface_metrics(mesh_og, mesh_dn))
 
 # Setup side-by-side plotting
 plotter = pv.Plotter(shape=(1, 2), window_size=(1200, 600))
@@ -19,6 +19,7 @@ from particle_vtools.Explorer3D import Explorer3D
 from particle_vtools.PoreStructure import PoreStructure_CT
 from particle_vtools.FluidStructure import FluidIterator_CT
 from particle_vtools.Particle import ParticleIterator_DF
+from particle_vtools.Comparison import ParticleComparison
 import argparse
 
 # Parse command line arguments
@@ -36,6 +37,8 @@ parser.add_argument(
     "--show_clip_panel", type=bool, default=False, help="Set to True to show the clip panel")  # noqa
 parser.add_argument(
     "--down_sample_factor", type=int, default=8, help="Scaling factor - larger factor means smaller image")  # noqa
+parser.add_argument(
+    "--match_radius", type=float, default=0, help="If > 0, match prediction to ground truth within this radius and colour the prediction by position error")  # noqa
 
 args = parser.parse_args()
 
@@ -47,6 +50,7 @@ frame_start = args.frame_start
 frame_end = args.frame_end
 show_clip_panel = args.show_clip_panel
 down_sample_factor = args.down_sample_factor
+match_radius = args.match_radius
 
 
 particle_pred_df_path = "/Users/chunyang/Downloads/all_frames_UPT.csv"  # noqa
@@ -87,6 +91,16 @@ if __name__ == "__main__":
     # print(particle_iterator_pred.get_particle(49))
     print("here")
 
+    pred_clim = clim
+    if match_radius > 0:
+        comparison = ParticleComparison(
+            particle_iterator_pred, particle_iterator_ground, match_radius)
+        print("Matching summary:", comparison.summary())
+        particle_iterator_pred.set_column(
+            "position_error", comparison.per_particle("position_error"))
+        particle_iterator_pred.color_by = "position_error"
+        pred_clim = [0, match_radius]
+
     p = pv.Plotter(
         title="Particle Prediction vs Ground Truth",
         shape=(1, 2),
@@ -101,7 +115,7 @@ if __name__ == "__main__":
         num_frames=frame_end - frame_start,
         plotter=p,
         clip_panel=show_clip_panel,
-        clim=clim,
+        clim=pred_clim,
         )
 
     explorer_ground = Explorer3D(
@@ -20,6 +20,8 @@ from natsort import natsorted
 # from particle_vtools.Explorer3D import Explorer3D
 # from particle_vtools.PoreStructure import PoreStructure_CT
 from particle_vtools.FluidStructure import FluidIterator_CT
+from particle_vtools.Particle import MagnitudeStats
+from particle_vtools.Sampling import subsample_tracks
 # from particle_vtools.Particle import ParticleIterator_DF
 # import argparse
 
@@ -79,14 +81,11 @@ def get_track(
     df = df.sort_values([id_key, 'frame'])
     df = df[(df.frame >= frame_start) & (df.frame <= frame_end)]
 
-    # Randomly select subset of particles
+    # Keep a reproducible, spatially stratified subset of tracks
     keep_frac = (100 - drop_percent)/100
-    unique_ids = df[id_key].unique()
-    selected_ids = np.random.choice(
-            unique_ids,
-            size=int(len(unique_ids)*keep_frac),
-            replace=False)
-    df = df[df[id_key].isin(selected_ids)]
+    budget = int(df[id_key].nunique()*keep_frac)
+    df = subsample_tracks(
+        df, budget, id_key=id_key, x_key=x_key, y_key=y_key, z_key=z_key)
 
     lines = []
     velocities = []
@@ -156,6 +155,10 @@ track_ground = get_track(
     frame_end=frame_end,
 )
 
+# Shared colour limits, computed once from the ground truth
+clim = MagnitudeStats.from_magnitudes(
+    track_ground['velocity']).clim(clim_low, clim_high)
+
 p = pv.Plotter(
     title="Particle Prediction vs Ground Truth",
     shape=(1, 2),
@@ -177,8 +180,7 @@ p.add_mesh(
     cmap=cmap,
     render_lines_as_tubes=True,
     opacity=opacity,
-    clim=[np.quantile(track_ground['velocity'], clim_low),
-          np.quantile(track_ground['velocity'], clim_high)],
+    clim=clim,
 )
 # p.add_mesh(
 #     surface,
@@ -202,8 +204,7 @@ p.add_mesh(
     cmap=cmap,
     render_lines_as_tubes=True,
     opacity=opacity,
-    clim=[np.quantile(track_ground['velocity'], clim_low),
-          np.quantile(track_ground['velocity'], clim_high)],
+    clim=clim,
 )
 # p.add_mesh(
 #     surface,
@@ -0,0 +1,64 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+Import time of the particle_vtools modules, each measured in a fresh
+interpreter (as a spawned worker process would pay it), along with the
+heavy dependencies the import pulled in. Exits with status 1 if any
+module is over the budget.
+
+Usage: python import_benchmark.py [--budget 0.3] [--repeat 3]
+"""
+
+import argparse
+import subprocess
+import sys
+
+modules = [
+    "particle_vtools",
+    "particle_vtools.SpatialIndex",
+    "particle_vtools.Particle",
+    "particle_vtools.FluidStructure",
+    "particle_vtools.PoreStructure",
+    "particle_vtools.Analysis",
+    "particle_vtools.Comparison",
+    "particle_vtools.MaskSeries",
+    "particle_vtools.SharedCache",
+    "particle_vtools.Explorer3D",
+]
+heavy = ["pyvista", "pandas", "sklearn", "skimage", "scipy", "tifffile"]
+
+probe = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ",".join(loaded))
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=0.3,
+                        help="seconds allowed per module import")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    over = []
+    for module in modules:
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, "-c",
+                 probe.format(module=module, heavy=heavy)],
+                capture_output=True, text=True, check=True).stdout
+            elapsed, _, loaded = \
+                output.strip().splitlines()[-1].partition(" ")
+            runs.append(float(elapsed))
+        best = min(runs)
+        flag = "" if best <= args.budget else "  OVER BUDGET"
+        print(f"{module:32s} {best * 1000:7.1f} ms  "
+              f"[{loaded or '-'}]{flag}")
+        if flag:
+            over.append(module)
+    sys.exit(1 if over else 0)
@@ -0,0 +1,54 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+Benchmark of a frame change in Explorer3D: marching cubes surfaces
+(render_mode="surface") against volume rendering of the label volume
+(render_mode="volume"). Also checks that the last frame renders
+differently from the first, i.e. that the frame change reached the
+screen.
+"""
+
+import glob
+import time
+import pyvista as pv
+from natsort import natsorted
+
+from particle_vtools.Explorer3D import Explorer3D
+from particle_vtools.FluidStructure import FluidIterator_CT
+
+down_sample_factor = 4
+num_frames = 20
+
+# Change the path to fit your data location
+ct_files_path = "../data/Segmentations/072/*"  # noqa
+
+if __name__ == "__main__":
+    ct_files = natsorted(glob.glob(ct_files_path))[:num_frames]
+
+    for render_mode in ["surface", "volume"]:
+        oil_iterator = FluidIterator_CT(
+            "oil", ct_files, threshold=255,
+            permute_axes=(2, 1, 0),
+            down_sample_factor=down_sample_factor,
+            )
+        explorer = Explorer3D(
+            [oil_iterator],
+            num_frames=num_frames,
+            plotter=pv.Plotter(off_screen=True),
+            clip_panel=False,
+            render_mode=render_mode,
+            )
+        explorer.set_scene3d(0)
+        explorer.plotter.render()
+        first = explorer.plotter.screenshot(return_img=True)
+        start = time.perf_counter()
+        for frame_idx in range(1, num_frames):
+            explorer.update_scene3d(frame_idx)
+            explorer.plotter.render()
+        per_frame = (time.perf_counter() - start) / (num_frames - 1)
+        last = explorer.plotter.screenshot(return_img=True)
+        changed = int((first != last).any(axis=-1).sum())
+        print(f"{render_mode}: {per_frame * 1000:.1f} ms per frame, "
+              f"{changed} pixels changed")
+        explorer.plotter.close()
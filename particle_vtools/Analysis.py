@@ -0,0 +1,338 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines the per-frame analysis of segmented fluid series.
+
+The entities are:
+- FluidMetrics
+- GanglionTracker
+- FluidIterator_Ganglion
+"""
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .FluidStructure import FluidIterator
+from .utils import LazyModule
+
+pd = LazyModule("pandas")
+ndimage = LazyModule("scipy.ndimage")
+measure = LazyModule("skimage.measure")
+
+
+def face_areas(verts, faces):
+    """
+    Area of each triangle.
+    """
+    a, b, c = (verts[faces[:, k]] for k in range(3))
+    return 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1)
+
+
+def frame_metrics(volume, threshold=1, pore_values=None,
+                  down_sample_factor=1, scale=None):
+    """
+    Metrics of one segmented frame, computed from voxels:
+    - saturation: fluid voxels / pore voxels (pore voxels are those with
+      a value in `pore_values`, or the whole volume if None)
+    - fluid_surface_area: area of the marching cubes fluid surface
+    - interfacial_area: the part of it between the fluid and the other
+      pore phase; faces touching a solid voxel (not in `pore_values`)
+      are fluid-solid contact and left out (all faces if None)
+    - ganglion_count: number of 26-connected fluid components
+    Areas use the (down sampled) surface and are in scaled units; `scale`
+    may be per axis of the volume.
+    """
+    fluid = volume == threshold
+    n_fluid = int(np.count_nonzero(fluid))
+    if pore_values is None:
+        n_pore = fluid.size
+    else:
+        n_pore = int(np.count_nonzero(np.isin(volume, pore_values)))
+    step = down_sample_factor
+    fluid_ds = fluid[::step, ::step, ::step]
+    area = interface_area = 0.0
+    if fluid_ds.any() and not fluid_ds.all():
+        verts, faces, _, _ = measure.marching_cubes(fluid_ds, level=0.5)
+        spacing = step * np.broadcast_to(
+            np.asarray(1 if scale is None else scale, dtype=np.float64),
+            (3,))
+        areas = face_areas(verts * spacing, faces)
+        area = areas.sum()
+        interface = np.ones(len(faces), dtype=bool)
+        if pore_values is not None:
+            solid = ~np.isin(volume[::step, ::step, ::step], pore_values)
+            # a face lies in the cell of voxels around its centroid: it is
+            # a contact face if any of them is solid
+            centroids = verts[faces].mean(axis=1)
+            shape = np.asarray(solid.shape)
+            lo = np.clip(np.floor(centroids).astype(np.int64), 0, shape - 1)
+            hi = np.clip(np.ceil(centroids).astype(np.int64), 0, shape - 1)
+            for corner in range(8):
+                pick = [(corner >> axis) & 1 for axis in range(3)]
+                ijk = np.where(pick, hi, lo)
+                interface &= ~solid[tuple(ijk.T)]
+        interface_area = areas[interface].sum()
+    _, ganglion_count = ndimage.label(
+        fluid_ds, structure=np.ones((3, 3, 3), dtype=bool))
+    return {
+        "saturation": n_fluid / max(n_pore, 1),
+        "fluid_voxels": n_fluid,
+        "fluid_surface_area": float(area),
+        "interfacial_area": float(interface_area),
+        "ganglion_count": int(ganglion_count),
+    }
+
+
+def _fluid_iterator_metrics(args):
+    fluid_iterator, index, pore_values, down_sample_factor = args
+    return frame_metrics(
+        fluid_iterator.get_volume(index),
+        threshold=fluid_iterator.threshold,
+        pore_values=pore_values,
+        down_sample_factor=down_sample_factor,
+        scale=fluid_iterator.scale)
+
+
+class FluidMetrics:
+    """
+    Saturation / surface and interfacial area / ganglion count time
+    series of a FluidIterator_CT. Every TIFF is read once, frames are
+    processed in a process pool, and results are cached (optionally to a
+    csv file).
+    """
+    def __init__(self,
+                 fluid_iterator,
+                 pore_values=None,
+                 down_sample_factor=None,
+                 cache_path=None,
+                 n_workers=4):
+        self.fluid_iterator = fluid_iterator
+        self.pore_values = pore_values
+        if down_sample_factor is None:
+            down_sample_factor = fluid_iterator.down_sample_factor
+        self.down_sample_factor = down_sample_factor
+        self.cache_path = cache_path
+        self.n_workers = n_workers
+        self.results = {}
+        if cache_path is not None:
+            self.load(cache_path)
+
+    def compute(self, indices=None):
+        """
+        Metrics of the given (all by default) frames, as a DataFrame.
+        Frames already computed are not read again.
+        """
+        if indices is None:
+            indices = range(len(self.fluid_iterator))
+        missing = [i for i in indices if i not in self.results]
+        if missing:
+            jobs = [(self.fluid_iterator, i, self.pore_values,
+                     self.down_sample_factor) for i in missing]
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                for index, result in zip(
+                        missing, pool.map(_fluid_iterator_metrics, jobs)):
+                    self.results[index] = result
+            if self.cache_path is not None:
+                self.save(self.cache_path)
+        return self.to_dataframe(indices)
+
+    def to_dataframe(self, indices=None):
+        if indices is None:
+            indices = sorted(self.results)
+        df = pd.DataFrame([self.results[i] for i in indices])
+        df.insert(0, "frame", list(indices))
+        return df
+
+    def save(self, path):
+        self.to_dataframe().to_csv(path, index=False)
+
+    def load(self, path):
+        try:
+            df = pd.read_csv(path)
+        except FileNotFoundError:
+            return
+        for row in df.to_dict("records"):
+            frame = int(row.pop("frame"))
+            self.results[frame] = row
+
+
+def _label_frame(args):
+    fluid_iterator, index, step = args
+    volume = fluid_iterator.get_volume(index)
+    mask = volume[::step, ::step, ::step] == fluid_iterator.threshold
+    labels, n = ndimage.label(
+        mask, structure=np.ones((3, 3, 3), dtype=bool))
+    return labels.astype(np.int32), n
+
+
+def overlap_pairs(labels_a, labels_b):
+    """
+    Voxel overlap between the components of two label volumes.
+    Returns (label_a, label_b, n_voxels) arrays over overlapping pairs.
+    """
+    both = (labels_a > 0) & (labels_b > 0)
+    a = labels_a[both].astype(np.int64)
+    b = labels_b[both].astype(np.int64)
+    n_b = int(labels_b.max()) + 1
+    pairs, counts = np.unique(a * n_b + b, return_counts=True)
+    return pairs // n_b, pairs % n_b, counts
+
+
+class GanglionTracker:
+    """
+    Connected component (ganglion) labelling of every frame of a
+    FluidIterator_CT, linked across consecutive frames by voxel overlap.
+    A component continues the track of the predecessor it overlaps most;
+    the other components of a split, and components formed by a merge,
+    start new tracks and are recorded in `events`.
+    """
+    def __init__(self,
+                 fluid_iterator,
+                 down_sample_factor=None,
+                 min_overlap=1,
+                 n_workers=4):
+        self.fluid_iterator = fluid_iterator
+        if down_sample_factor is None:
+            down_sample_factor = fluid_iterator.down_sample_factor
+        self.down_sample_factor = down_sample_factor
+        self.min_overlap = min_overlap
+        self.n_workers = n_workers
+        self.labels = {}
+        # per frame: track id of every label (index 0 = background, -1)
+        self.track_luts = {}
+        self.events = []
+        self.n_tracks = 0
+
+    def label_frames(self, indices):
+        missing = [i for i in indices if i not in self.labels]
+        jobs = [(self.fluid_iterator, i, self.down_sample_factor)
+                for i in missing]
+        with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+            for index, result in zip(missing, pool.map(_label_frame, jobs)):
+                self.labels[index] = result
+        return {i: self.labels[i] for i in indices}
+
+    def _new_tracks(self, n):
+        ids = np.arange(self.n_tracks, self.n_tracks + n)
+        self.n_tracks += n
+        return ids
+
+    def track(self, indices=None):
+        """
+        Label and link the given (all by default) consecutive frames.
+        """
+        if indices is None:
+            indices = range(len(self.fluid_iterator))
+        indices = list(indices)
+        self.label_frames(indices)
+        self.track_luts = {}
+        self.events = []
+        self.n_tracks = 0
+        prev = None
+        for index in indices:
+            labels, n = self.labels[index]
+            lut = np.full(n + 1, -1, dtype=np.int64)
+            if prev is None:
+                lut[1:] = self._new_tracks(n)
+            else:
+                prev_labels, _ = self.labels[prev]
+                prev_lut = self.track_luts[prev]
+                a, b, counts = overlap_pairs(prev_labels, labels)
+                keep = counts >= self.min_overlap
+                a, b, counts = a[keep], b[keep], counts[keep]
+                n_succ = np.bincount(a, minlength=len(prev_lut))
+                n_pred = np.bincount(b, minlength=n + 1)
+                # strongest overlaps first: each old track continues once,
+                # a component merging several predecessors starts anew
+                taken = set()
+                for k in np.argsort(-counts, kind='stable'):
+                    track_a = prev_lut[a[k]]
+                    if lut[b[k]] >= 0 or track_a in taken or \
+                            n_pred[b[k]] > 1:
+                        continue
+                    lut[b[k]] = track_a
+                    taken.add(track_a)
+                unlinked = np.nonzero(lut[1:] < 0)[0] + 1
+                lut[unlinked] = self._new_tracks(len(unlinked))
+                for label_a in np.nonzero(n_succ > 1)[0]:
+                    self.events.append({
+                        "frame": index, "type": "split",
+                        "from": [int(prev_lut[label_a])],
+                        "to": sorted(int(lut[lb])
+                                     for lb in b[a == label_a])})
+                for label_b in np.nonzero(n_pred > 1)[0]:
+                    self.events.append({
+                        "frame": index, "type": "merge",
+                        "from": sorted(int(prev_lut[la])
+                                       for la in a[b == label_b]),
+                        "to": [int(lut[label_b])]})
+            self.track_luts[index] = lut
+            prev = index
+        return self.events
+
+    def get_track_volume(self, index):
+        """
+        Down sampled volume of track ids (-1 outside the fluid).
+        """
+        labels, _ = self.labels[index]
+        return self.track_luts[index][labels]
+
+    def vertex_tracks(self, index, points):
+        """
+        Track id of each surface vertex (mesh coordinates). Vertices lie
+        between voxels, so the largest label of the two voxels around
+        each coordinate is taken.
+        """
+        it = self.fluid_iterator
+        coords = np.asarray(points, dtype=np.float64)
+        if it.permute_axes:
+            coords = coords[:, np.argsort(it.permute_axes)]
+        if it.scale:
+            coords = coords / it.scale
+        coords = coords / self.down_sample_factor
+        labels, _ = self.labels[index]
+        shape = np.asarray(labels.shape)
+        lo = np.clip(np.floor(coords).astype(np.int64), 0, shape - 1)
+        hi = np.clip(np.ceil(coords).astype(np.int64), 0, shape - 1)
+        best = np.zeros(len(coords), dtype=np.int64)
+        for corner in range(8):
+            pick = [(corner >> axis) & 1 for axis in range(3)]
+            ijk = np.where(pick, hi, lo)
+            best = np.maximum(best, labels[tuple(ijk.T)])
+        return self.track_luts[index][best]
+
+
+class FluidIterator_Ganglion(FluidIterator):
+    """
+    Fluid surfaces of a tracked FluidIterator_CT with per-vertex
+    'ganglion_track' and 'ganglion_colour' (track id modulo `n_colours`,
+    so the colour range does not grow with new tracks, e.g.
+    Explorer3D(fluid_scalars='ganglion_colour', fluid_clim=[0, 19]))
+    arrays; `track_ids` restricts them to those tracks. The underlying
+    surface is reused, only the scalars / kept cells change.
+    """
+    def __init__(self, name, tracker, track_ids=None, n_colours=20):
+        super().__init__(name)
+        self.tracker = tracker
+        self.track_ids = track_ids
+        self.n_colours = n_colours
+
+    def get_geo(self, index):
+        return self.tracker.fluid_iterator.get_geo(index)
+
+    def get_surface(self, index):
+        mesh = self.tracker.fluid_iterator[index].copy(deep=False)
+        tracks = self.tracker.vertex_tracks(index, mesh.points)
+        mesh['ganglion_track'] = tracks
+        mesh['ganglion_colour'] = np.where(
+            tracks < 0, -1, tracks % self.n_colours)
+        if self.track_ids is not None:
+            keep = np.isin(mesh['ganglion_track'], self.track_ids)
+            faces = mesh.regular_faces
+            drop = ~keep[faces].all(axis=1)
+            mesh = mesh.remove_cells(drop)
+        return mesh
+
+    def __len__(self):
+        return len(self.tracker.fluid_iterator)
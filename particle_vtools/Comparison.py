@@ -0,0 +1,250 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines the quantitative comparison between predicted and
+ground-truth particles, and between surfaces of the same phase meshed at
+different resolutions.
+
+The entities are:
+- ParticleComparison
+"""
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .SpatialIndex import build_tree
+from .utils import LazyModule
+
+optimize = LazyModule("scipy.optimize")
+
+
+def match_particles(pred_positions, gt_positions, radius, optimal=False):
+    """
+    Match predicted to ground-truth particles within `radius`.
+    By default the candidate pairs within `radius` are taken closest
+    first, each particle at most once (greedy, one-to-one). With
+    `optimal`, the matching minimises the total distance among all pairs
+    within `radius`.
+    Returns (pred_idx, gt_idx) of the matched pairs.
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if len(pred_positions) == 0 or len(gt_positions) == 0:
+        return empty, empty
+    pairs = build_tree(pred_positions).sparse_distance_matrix(
+        build_tree(gt_positions), radius, output_type='ndarray')
+    if len(pairs) == 0:
+        return empty, empty
+    if not optimal:
+        # walk the candidate pairs closest first, taking a pair when both
+        # of its particles are still free
+        order = np.argsort(pairs['v'], kind='stable')
+        pred_free = np.ones(len(pred_positions), dtype=bool)
+        gt_free = np.ones(len(gt_positions), dtype=bool)
+        pred_idx, gt_idx = [], []
+        for i, j in zip(pairs['i'][order], pairs['j'][order]):
+            if pred_free[i] and gt_free[j]:
+                pred_free[i] = gt_free[j] = False
+                pred_idx.append(i)
+                gt_idx.append(j)
+        pred_idx = np.asarray(pred_idx, dtype=np.int64)
+        gt_idx = np.asarray(gt_idx, dtype=np.int64)
+        keep = np.argsort(pred_idx, kind='stable')
+        return pred_idx[keep], gt_idx[keep]
+
+    rows, row_idx = np.unique(pairs['i'], return_inverse=True)
+    cols, col_idx = np.unique(pairs['j'], return_inverse=True)
+    # pairs further than radius get a prohibitive cost
+    big = radius * (len(rows) + len(cols) + 1)
+    cost = np.full((len(rows), len(cols)), big)
+    cost[row_idx, col_idx] = pairs['v']
+    r, c = optimize.linear_sum_assignment(cost)
+    valid = cost[r, c] < big
+    return rows[r[valid]], cols[c[valid]]
+
+
+class ParticleComparison:
+    """
+    Per-frame matching of a prediction iterator against a ground-truth
+    iterator, with position / velocity errors per matched particle.
+    Frames are processed in a thread pool and cached.
+    """
+    def __init__(self,
+                 pred_iterator,
+                 gt_iterator,
+                 radius,
+                 optimal=False,
+                 n_workers=4):
+        self.pred_iterator = pred_iterator
+        self.gt_iterator = gt_iterator
+        self.radius = radius
+        self.optimal = optimal
+        self.n_workers = n_workers
+        self.results = {}
+
+    def compare_frame(self, frame):
+        """
+        Match one frame. The returned dict holds the matched indices, the
+        per-pair errors and per-prediction error scalars (NaN if the
+        prediction is unmatched).
+        """
+        if frame in self.results:
+            return self.results[frame]
+        pred_pos, pred_vel = self.pred_iterator.get_particle(frame)
+        gt_pos, gt_vel = self.gt_iterator.get_particle(frame)
+        pred_idx, gt_idx = match_particles(
+            pred_pos, gt_pos, self.radius, self.optimal)
+        position_error = np.linalg.norm(
+            pred_pos[pred_idx] - gt_pos[gt_idx], axis=1)
+        velocity_error = np.linalg.norm(
+            pred_vel[pred_idx] - gt_vel[gt_idx], axis=1)
+        per_particle = {}
+        for name, error in [("position_error", position_error),
+                            ("velocity_error", velocity_error)]:
+            values = np.full(len(pred_pos), np.nan)
+            values[pred_idx] = error
+            per_particle[name] = values
+        result = {
+            "pred_idx": pred_idx,
+            "gt_idx": gt_idx,
+            "n_pred": len(pred_pos),
+            "n_gt": len(gt_pos),
+            "position_error": position_error,
+            "velocity_error": velocity_error,
+            "per_particle": per_particle,
+        }
+        self.results[frame] = result
+        return result
+
+    def compare(self, frames=None):
+        """
+        Match all (or the given) frames shared by both iterators.
+        """
+        if frames is None:
+            frames = sorted(set(self.pred_iterator.get_frames()) &
+                            set(self.gt_iterator.get_frames()))
+        frames = list(frames)
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            list(pool.map(self.compare_frame, frames))
+        return {frame: self.results[frame] for frame in frames}
+
+    def summary(self, frames=None, quantiles=(0.5, 0.9, 0.99)):
+        """
+        Error distributions pooled over frames.
+        """
+        results = self.compare(frames)
+        n_pred = sum(r["n_pred"] for r in results.values())
+        n_gt = sum(r["n_gt"] for r in results.values())
+        n_matched = sum(len(r["pred_idx"]) for r in results.values())
+        summary = {
+            "n_frames": len(results),
+            "precision": n_matched / max(n_pred, 1),
+            "recall": n_matched / max(n_gt, 1),
+        }
+        for name in ["position_error", "velocity_error"]:
+            errors = np.concatenate(
+                [r[name] for r in results.values()] + [np.zeros(0)])
+            if len(errors) == 0:
+                continue
+            summary[name] = {
+                "mean": float(errors.mean()),
+                "rmse": float(np.sqrt(np.mean(errors ** 2))),
+                "quantiles": dict(zip(
+                    quantiles, np.quantile(errors, quantiles).tolist())),
+            }
+        return summary
+
+    def per_particle(self, name="position_error", frames=None):
+        """
+        {frame: per-prediction error}, ready for
+        ParticleIterator_DF.set_column to colour the prediction view.
+        """
+        results = self.compare(frames)
+        return {frame: r["per_particle"][name]
+                for frame, r in results.items()}
+
+
+def surface_distance(source, target):
+    """
+    Signed distance from every vertex of `source` to the surface of
+    `target` (VTK implicit distance, accelerated by a cell locator).
+    """
+    if source.n_points == 0:
+        return np.zeros(0)
+    if target.n_points == 0:
+        return np.full(source.n_points, np.inf)
+    result = source.compute_implicit_distance(target)
+    return np.asarray(result['implicit_distance'])
+
+
+def surface_metrics(mesh_a, mesh_b, per_vertex=False):
+    """
+    Symmetric surface distances between two meshes: Hausdorff, mean and
+    RMS of the unsigned vertex-to-surface distances in both directions.
+    With `per_vertex` the signed distances of each side are returned too
+    (as 'distance_a' on mesh_a and 'distance_b' on mesh_b).
+    """
+    d_ab = surface_distance(mesh_a, mesh_b)
+    d_ba = surface_distance(mesh_b, mesh_a)
+    both = np.abs(np.concatenate([d_ab, d_ba]))
+    metrics = {
+        "hausdorff": float(both.max()) if len(both) else 0.0,
+        "mean": float(both.mean()) if len(both) else 0.0,
+        "rms": float(np.sqrt(np.mean(both ** 2))) if len(both) else 0.0,
+        "n_points_a": mesh_a.n_points,
+        "n_points_b": mesh_b.n_points,
+    }
+    if per_vertex:
+        metrics["distance_a"] = d_ab
+        metrics["distance_b"] = d_ba
+    return metrics
+
+
+def _surface_metrics_frame(args):
+    iterator_a, iterator_b, index = args
+    return surface_metrics(iterator_a[index], iterator_b[index])
+
+
+def compare_surface_series(iterator_a, iterator_b, indices=None,
+                           n_workers=4):
+    """
+    surface_metrics of two fluid iterators (e.g. the same files at two
+    down_sample_factor values) frame by frame, one process per frame.
+    """
+    if indices is None:
+        indices = range(min(len(iterator_a), len(iterator_b)))
+    jobs = [(iterator_a, iterator_b, index) for index in indices]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(_surface_metrics_frame, jobs))
+
+
+def _candidate_metrics_frame(args):
+    iterators, reference, index, metric = args
+    # the reference is the most expensive mesh: built once per frame
+    reference_mesh = reference[index]
+    return {factor: surface_metrics(iterator[index], reference_mesh)[metric]
+            for factor, iterator in iterators.items()}
+
+
+def cheapest_resolution(iterators, reference, target, indices=None,
+                        metric="hausdorff", n_workers=4):
+    """
+    Pick the cheapest iterator meeting an accuracy target.
+    iterators: {down_sample_factor: iterator}, compared against the
+    `reference` iterator; the largest factor whose worst frame `metric`
+    is <= target wins. Returns (factor or None, {factor: worst metric}).
+    Each frame is one process, meshing the reference once for all the
+    candidates.
+    """
+    if indices is None:
+        indices = range(min(len(it) for it in
+                            list(iterators.values()) + [reference]))
+    jobs = [(iterators, reference, index, metric) for index in indices]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        frames = list(pool.map(_candidate_metrics_frame, jobs))
+    worst = {}
+    for factor in sorted(iterators, reverse=True):
+        worst[factor] = max(frame[factor] for frame in frames)
+        if worst[factor] <= target:
+            return factor, worst
+    return None, worst
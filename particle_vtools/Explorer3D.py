@@ -14,8 +14,18 @@ plot the velocity field within the surface of the porous media.
 Users can interact with the 3D scene by rotating, zooming, and panning,
 as well as using a slider bar to move along time axis.
 """
+import numpy as np
 import pyvista as pv
 
+from vtkmodules.vtkCommonDataModel import vtkPiecewiseFunction, vtkPlane
+from vtkmodules.vtkRenderingCore import vtkColorTransferFunction
+
+from .Playback import Playback
+from .SpatialIndex import (
+    BoxROI, FrustumROI, HalfSpaceROI, IntersectionROI, SphereROI)
+from .Streamline import seeds_from_plane
+from .utils import swap_geometry
+
 
 class Explorer3D:
     def __init__(
@@ -30,6 +40,12 @@ class Explorer3D:
         plotter=None,
         clip_panel=True,
         clim=[0, 7],
+        fluid_scalars=None,
+        fluid_cmap="tab20",
+        fluid_clim=None,
+        clip_mode="geometry",
+        render_mode="surface",
+        volume_opacity=0.3,
     ):
         self.pore_structure = pore_structure
         self.fluid_iterators = fluid_iterators
@@ -39,13 +55,50 @@ class Explorer3D:
         self.particle_cmap = particle_cmap
         self.plotter = plotter
         self.clip_panel = clip_panel
+        # "geometry": a clipped copy per mesh (add_mesh_clip_plane)
+        # "mapper": one implicit plane shared by every actor's mapper,
+        # driven by a single widget - no geometry is recomputed
+        self.clip_mode = clip_mode
+        self.clip_plane = None
+        # "surface": marching cubes meshes, "volume": volume rendering of
+        # the down sampled label volumes (no surface extraction)
+        self.render_mode = render_mode
+        self.volume_opacity = volume_opacity
+        if clip_panel and clip_mode == "mapper":
+            self.clip_plane = vtkPlane()
+        # clim=None: dataset-wide limits from the first velocity iterator
+        if clim is None and velocity_iterators:
+            clim = velocity_iterators[0].get_clim()
         self.clim = clim
+        # colour fluid surfaces by a point array (e.g. 'ganglion_track')
+        self.fluid_scalars = fluid_scalars
+        self.fluid_cmap = fluid_cmap
+        # fixed scalar range of the fluid colours: without it the range of
+        # the first frame is kept for every later frame
+        self.fluid_clim = fluid_clim
 
         self.setup(bg_color)
         self.set_light()
 
+        # the scene owns one actor per layer entry, created once by
+        # set_scene3d; frames are copied into their meshes in place
+        self.layers = {
+            "fluid": [], "velocity": [], "pore": [], "streamlines": []}
+        self.scene_ready = False
         self.fluid_surfaces = []
+        self.velocity_meshes = []
         self.velocity_arrows = []
+        self.frame_idx = 0
+        self.streamline_mesh = None
+        self.streamline_actor = None
+        # called with the frame index after every scene update
+        self.frame_callbacks = []
+        # view culling of the particles (enable_culling): the region this
+        # view shows, passed to get_glyph rather than set on the shared
+        # iterators
+        self.cull_margin = None
+        self.cull = None
+        self._cull_camera = None
 
     def setup(self, bg_color):
         if self.plotter is None:
@@ -53,83 +106,422 @@ class Explorer3D:
                 window_size=[1600, 1600],
                 title="Particle-vtools (3D Explorer)")
             pv.global_theme.background = bg_color
+        # velocity / streamline actors are created before there is
+        # anything to show in them
+        self.plotter.theme.allow_empty_mesh = True
 
     def set_light(self):
         light = pv.Light()
         light.set_direction_angle(30, 30)
 
+    def clip_actor(self, actor):
+        """
+        Attach the shared clipping plane (mapper clip mode) to an actor.
+        """
+        if self.clip_plane is not None and actor is not None:
+            actor.mapper.AddClippingPlane(self.clip_plane)
+        return actor
+
+    def add_to_layer(self, layer, actor):
+        """
+        Register an actor with a scene layer (and the mapper clip plane).
+        """
+        self.layers[layer].append(self.clip_actor(actor))
+        return actor
+
+    def set_layer_visibility(self, layer, visible=True):
+        """
+        Show / hide every actor of a layer: "fluid", "velocity", "pore"
+        or "streamlines".
+        """
+        for actor in self.layers[layer]:
+            actor.SetVisibility(visible)
+
+    def add_layer_toggles(self, position=(10, 10), size=30):
+        """
+        One checkbox per non-empty layer to switch its visibility.
+        """
+        x, y = position
+        for layer, actors in self.layers.items():
+            if not actors:
+                continue
+            self.plotter.add_checkbox_button_widget(
+                lambda visible, layer=layer: self.set_layer_visibility(
+                    layer, visible),
+                value=True, position=(x, y), size=size)
+            self.plotter.add_text(
+                layer, position=(x + size + 10, y + size // 4),
+                font_size=10, color="black")
+            y += size + 10
+
+    def set_clip_widget(self, normal='-z'):
+        """
+        Single plane widget driving the shared clipping plane; keeps the
+        side the normal points to.
+        """
+        bounds = self.plotter.bounds
+        origin = [(bounds[2 * i] + bounds[2 * i + 1]) / 2 for i in range(3)]
+
+        def callback(normal, origin):
+            self.clip_plane.SetNormal(normal)
+            self.clip_plane.SetOrigin(origin)
+            if self.cull_margin is not None:
+                self.update_culling(force=True)
+
+        self.plotter.add_plane_widget(
+            callback, normal=normal, origin=origin, bounds=bounds,
+            outline_opacity=0.1)
+
+    def add_label_volume(self, image, label, color):
+        """
+        Volume render one label of a label volume (per-label transfer
+        function: `label` gets `color` / volume_opacity, others are
+        transparent).
+        """
+        label = float(label)
+        actor = self.plotter.add_volume(
+            image, scalars='label', show_scalar_bar=False)
+        opacity = vtkPiecewiseFunction()
+        opacity.AddPoint(label - 0.5, 0.0)
+        opacity.AddPoint(label, self.volume_opacity)
+        opacity.AddPoint(label + 0.5, 0.0)
+        colors = vtkColorTransferFunction()
+        for value in (label - 0.5, label + 0.5):
+            colors.AddRGBPoint(value, *pv.Color(color).float_rgb)
+        actor.prop.SetScalarOpacity(opacity)
+        actor.prop.SetColor(colors)
+        return actor
+
+    def add_velocity_arrows(self, velocity_iterator):
+        """
+        Add the glyph actor of a velocity iterator. It starts empty; each
+        frame is copied into its mesh, so the mapper, lookup table and
+        scalar bar are reused.
+        """
+        scalars = velocity_iterator.color_by
+        velocity = pv.PolyData()
+        velocity.point_data[scalars] = np.empty(0, dtype=np.float32)
+        title = scalars
+        if title == "mags":
+            title = "Velocity Magnitude"
+        actor = self.plotter.add_mesh(
+            velocity,
+            scalars=scalars,
+            cmap=self.particle_cmap,
+            clim=self.clim,
+            scalar_bar_args={
+                'title': title
+                },
+            )
+        self.velocity_meshes.append(velocity)
+        self.velocity_arrows.append(actor)
+        return self.add_to_layer("velocity", actor)
+
     def set_scene3d(self, frame_idx):
+        if self.scene_ready:
+            # the actors already exist: only move to the frame
+            self.update_scene3d(frame_idx)
+            return
+        self.scene_ready = True
         frame_idx = int(frame_idx)
+        self.frame_idx = frame_idx
         print("Setting scene to frame", frame_idx)
         # set fulid surface
-        if self.fluid_iterators is not None:
+        if self.fluid_iterators is not None and \
+                self.render_mode == "volume":
+            for fluid_iterator in self.fluid_iterators:
+                image = fluid_iterator.get_image(frame_idx)
+                actor = self.add_label_volume(
+                    image, fluid_iterator.threshold, "blue")
+                # add_volume renders a copy of the image: later frames
+                # go into the dataset the mapper actually reads
+                self.fluid_surfaces.append(actor.mapper.dataset)
+                self.add_to_layer("fluid", actor)
+        elif self.fluid_iterators is not None:
             for fluid_iterator in self.fluid_iterators:
-                fluid_mesh = fluid_iterator[frame_idx]
+                # shallow copy: later frames are swapped into this mesh
+                # without touching the iterator's (possibly cached) mesh
+                fluid_mesh = fluid_iterator[frame_idx].copy(deep=False)
                 self.fluid_surfaces.append(fluid_mesh)
-                self.plotter.add_mesh(
+                if self.fluid_scalars is not None:
+                    colour = dict(scalars=self.fluid_scalars,
+                                  cmap=self.fluid_cmap,
+                                  clim=self.fluid_clim,
+                                  show_scalar_bar=False)
+                else:
+                    colour = dict(color="blue")
+                actor = self.plotter.add_mesh(
                     fluid_mesh,
-                    color="blue",
+                    **colour,
                     pbr=True,
                     metallic=0.1,
                     roughness=0.01,
                     diffuse=1,
                     opacity=self.surface_transparency)
-                if self.clip_panel:
-                    self.plotter.add_mesh_clip_plane(
+                self.add_to_layer("fluid", actor)
+                if self.clip_panel and self.clip_plane is None:
+                    # invert=False keeps the side the normal points to,
+                    # like the mapper clip plane (older pyvista defaults
+                    # to invert=True)
+                    clipped = self.plotter.add_mesh_clip_plane(
                         fluid_mesh,
                         normal='-z',
                         origin=fluid_mesh.center,
+                        invert=False,
                         color="blue", outline_opacity=0.1)
+                    self.add_to_layer("fluid", clipped)
 
         # set particle velocity arrow
         if self.velocity_iterators is not None:
             for velocity_iterator in self.velocity_iterators:
-                velocity = velocity_iterator[frame_idx]
-                actor = self.plotter.add_mesh(
-                    velocity,
-                    # cmap=self.particle_cmap,
-                    cmap=self.particle_cmap,
-                    clim=self.clim,
-                    scalar_bar_args={
-                        'title': "Velocity Magnitude"
-                        },
-                )
-                self.velocity_arrows.append(actor)
+                self.add_velocity_arrows(velocity_iterator)
+            self.update_velocity(frame_idx)
 
         # set pore structure
         if self.pore_structure is not None:
-            pore_mesh = self.pore_structure.get_surface()
-            if self.clip_panel:
-                self.plotter.add_mesh_clip_plane(
+            if self.render_mode == "volume":
+                self.add_to_layer("pore", self.add_label_volume(
+                    self.pore_structure.get_image(),
+                    self.pore_structure.threshold, "grey"))
+            elif self.clip_plane is not None:
+                pore_mesh = self.pore_structure.get_surface()
+                self.add_to_layer(
+                    "pore", self.plotter.add_mesh(pore_mesh, color="grey"))
+            elif self.clip_panel:
+                pore_mesh = self.pore_structure.get_surface()
+                self.add_to_layer("pore", self.plotter.add_mesh_clip_plane(
                     pore_mesh,
                     normal='x', origin=pore_mesh.center,
-                    color="grey")
+                    invert=False,
+                    color="grey"))
+
+        if self.clip_plane is not None:
+            self.set_clip_widget()
 
-    def update_scene3d(self, frame_idx):
+    def load_frame(self, frame_idx):
+        """
+        Read / compute everything update_scene3d shows for a frame, without
+        touching the scene (safe to call from a worker thread).
+        Returns (fluid meshes or images, velocity glyphs).
+        """
+        fluids = []
+        if self.fluid_iterators is not None:
+            for fluid_iterator in self.fluid_iterators:
+                if self.render_mode == "volume":
+                    fluids.append(fluid_iterator.get_image(frame_idx))
+                else:
+                    fluids.append(fluid_iterator[frame_idx])
+        velocities = []
+        if self.velocity_iterators is not None:
+            for velocity_iterator in self.velocity_iterators:
+                velocities.append(
+                    velocity_iterator.get_glyph(frame_idx, cull=self.cull))
+        return fluids, velocities
+
+    def update_scene3d(self, frame_idx, frame_data=None):
         frame_idx = int(frame_idx)
+        self.frame_idx = frame_idx
         print(f"Updating scene to frame {frame_idx}")
-        if self.fluid_iterators is not None:
-            for i, fluid_iterator in enumerate(self.fluid_iterators):
-                fluid_surface_i = fluid_iterator[frame_idx]
-                self.fluid_surfaces[i].points = fluid_surface_i.points
-                self.fluid_surfaces[i].faces = fluid_surface_i.faces
+        if frame_data is None:
+            frame_data = self.load_frame(frame_idx)
+        fluids, velocities = frame_data
+        for i, fluid in enumerate(fluids):
+            if self.render_mode == "volume":
+                # only the 3D texture changes
+                self.fluid_surfaces[i].copy_from(fluid, deep=False)
+            else:
+                swap_geometry(self.fluid_surfaces[i], fluid)
 
-        if self.velocity_iterators is not None:
-            for i, velocity_iterator in enumerate(self.velocity_iterators):
-                # Remove old arrows
-                if self.velocity_arrows[i] is not None:
-                    self.plotter.remove_actor(self.velocity_arrows[i])
-                # Generate new velocity arrows
-                velocity_arrow_i = velocity_iterator[frame_idx]
-                # actor.SetVisibility(True)
-                self.velocity_arrows[i] = self.plotter.add_mesh(
-                    velocity_arrow_i,
-                    cmap=self.particle_cmap,
-                    clim=self.clim,
-                    scalar_bar_args={
-                        'title': "Velocity Magnitude"
-                        },
-                    )
+        self.update_velocity(frame_idx, velocities)
+        for callback in self.frame_callbacks:
+            callback(frame_idx)
+
+    def update_velocity(self, frame_idx, velocities=None):
+        if self.velocity_iterators is None:
+            return
+        if velocities is None:
+            velocities = [
+                velocity_iterator.get_glyph(frame_idx, cull=self.cull)
+                for velocity_iterator in self.velocity_iterators]
+        for i, velocity_arrow_i in enumerate(velocities):
+            self.velocity_meshes[i].copy_from(velocity_arrow_i, deep=False)
+            # follows a change of the iterator's color_by
+            scalars = velocity_arrow_i.active_scalars_name
+            if scalars is not None:
+                self.velocity_arrows[i].mapper.array_name = scalars
+
+    def set_roi(self, roi):
+        """
+        Only show the particles inside `roi` (None to show all).
+        """
+        if self.velocity_iterators is None:
+            return
+        for velocity_iterator in self.velocity_iterators:
+            velocity_iterator.set_roi(roi)
+        if self.scene_ready:
+            self.update_velocity(self.frame_idx)
+
+    def set_roi_widget(self, kind="box", bounds=None, radius=None):
+        """
+        Add an interactive widget that filters the particles on screen.
+        kind: "box", "sphere" or "plane" (keeps the side the normal
+        points to, like the clip planes).
+        """
+        if bounds is None:
+            bounds = self.plotter.bounds
+        if kind == "box":
+            self.plotter.add_box_widget(
+                lambda box: self.set_roi(BoxROI.from_bounds(box.bounds)),
+                bounds=bounds, rotation_enabled=False)
+        elif kind == "sphere":
+            center = [(bounds[2 * i] + bounds[2 * i + 1]) / 2
+                      for i in range(3)]
+            if radius is None:
+                radius = (bounds[1] - bounds[0]) / 4
+            self.plotter.add_sphere_widget(
+                lambda c: self.set_roi(SphereROI(c, radius)),
+                center=center, radius=radius)
+        elif kind == "plane":
+            self.plotter.add_plane_widget(
+                lambda normal, origin: self.set_roi(
+                    HalfSpaceROI(origin, normal)),
+                bounds=bounds)
+        else:
+            raise ValueError(f"Unknown ROI widget kind: {kind}")
+
+    def enable_culling(self, margin=0.1):
+        """
+        Only glyph the particles in the camera view (and on the kept side
+        of the mapper clip plane). The view is widened by `margin` times
+        its half width at the focal point, and the particles are culled
+        again only when the camera moves / zooms by more than that.
+        """
+        self.cull_margin = margin
+        self.plotter.camera.AddObserver(
+            "ModifiedEvent", lambda *args: self.update_culling())
+        self.update_culling(force=True)
+
+    def update_culling(self, force=False):
+        if self.velocity_iterators is None or self.cull_margin is None:
+            return
+        camera = self.plotter.camera
+        state = np.array([
+            *camera.GetPosition(), *camera.GetFocalPoint(),
+            *camera.GetViewUp(), camera.GetViewAngle(),
+            camera.GetParallelScale()])
+        if camera.GetParallelProjection():
+            half_width = camera.GetParallelScale()
+        else:
+            half_width = camera.GetDistance() * np.tan(
+                np.radians(camera.GetViewAngle()) / 2)
+        margin = self.cull_margin * half_width
+        if not force and self._cull_camera is not None:
+            change = np.abs(state - self._cull_camera)
+            zoom = change[9:] / np.maximum(self._cull_camera[9:], 1e-12)
+            if change[:6].max() < margin / 2 and \
+                    change[6:9].max() < self.cull_margin and \
+                    zoom.max() < self.cull_margin:
+                return
+        self._cull_camera = state
+        cull = FrustumROI.from_camera(
+            camera, self.plotter.renderer.GetTiledAspectRatio(),
+            margin=margin)
+        if self.clip_plane is not None:
+            cull = IntersectionROI(cull, HalfSpaceROI(
+                self.clip_plane.GetOrigin(), self.clip_plane.GetNormal()))
+        self.cull = cull
+        if self.scene_ready:
+            self.update_velocity(self.frame_idx)
+
+    def add_velocity_field(self, image, style="slice", factor=None):
+        """
+        Show a gridded velocity field (VelocityGrid.to_image()), either as
+        three orthogonal slices or as mean-velocity glyphs per cell.
+        """
+        if style == "slice":
+            mesh = image.slice_orthogonal()
+        elif style == "glyph":
+            centers = image.cell_centers().threshold(0.5, scalars='count')
+            if factor is None:
+                factor = float(min(image.spacing))
+            mesh = centers.glyph(
+                orient='velocity', scale=False, factor=factor,
+                geom=pv.Arrow())
+        else:
+            raise ValueError(f"Unknown velocity field style: {style}")
+        return self.plotter.add_mesh(
+            mesh,
+            scalars='mags',
+            cmap=self.particle_cmap,
+            clim=self.clim,
+            scalar_bar_args={
+                'title': "Mean Velocity Magnitude"
+                },
+            )
+
+    def set_streamlines(self, lines):
+        """
+        Replace the displayed streamlines with `lines` (PolyData), in the
+        same actor.
+        """
+        if self.streamline_actor is None:
+            self.streamline_mesh = pv.PolyData()
+            self.streamline_mesh.point_data['mags'] = np.empty(
+                0, dtype=np.float32)
+            self.streamline_actor = self.plotter.add_mesh(
+                self.streamline_mesh,
+                scalars='mags',
+                cmap=self.particle_cmap,
+                clim=self.clim,
+                render_lines_as_tubes=True,
+                line_width=3,
+                show_scalar_bar=False,
+                )
+            self.add_to_layer("streamlines", self.streamline_actor)
+        self.streamline_mesh.copy_from(lines, deep=False)
+
+    def show_streamlines(self, visible=True):
+        self.set_layer_visibility("streamlines", visible)
+
+    def set_streamline_widget(self, tracer, frames, size=None,
+                              resolution=10, normal='x'):
+        """
+        Seed streamlines of `tracer` (StreamlineTracer) over `frames`
+        from a square patch of an interactive plane.
+        """
+        bounds = self.plotter.bounds
+        if size is None:
+            size = max(bounds[1] - bounds[0],
+                       bounds[3] - bounds[2],
+                       bounds[5] - bounds[4])
+
+        def callback(normal, origin):
+            seeds = seeds_from_plane(origin, normal, size, resolution)
+            self.set_streamlines(tracer.streamlines(frames, seeds))
+
+        self.plotter.add_plane_widget(
+            callback, normal=normal, bounds=bounds)
+
+    def add_metric_chart(self, metrics, key, loc=(0.6, 0.05),
+                         size=(0.38, 0.25)):
+        """
+        2D chart of a per-frame metric (DataFrame with a 'frame' column,
+        e.g. FluidMetrics.compute()) with a marker that follows the time
+        slider.
+        """
+        x = metrics['frame'].to_numpy()
+        y = metrics[key].to_numpy()
+        chart = pv.Chart2D(size=size, loc=loc, x_label='Frame', y_label=key)
+        chart.line(x, y, color='blue', width=2)
+        low, high = float(y.min()), float(y.max())
+        marker = chart.line(
+            [self.frame_idx, self.frame_idx], [low, high],
+            color='red', width=1)
+        self.plotter.add_chart(chart)
+        self.frame_callbacks.append(
+            lambda frame_idx: marker.update(
+                [frame_idx, frame_idx], [low, high]))
+        return chart
 
     def set_time_slider(self, start=0):
         start = start
@@ -139,11 +531,17 @@ class Explorer3D:
             [start, end],
             title='Frame', value=0)
 
-    def auto_animation(self):
+    def auto_animation(self, fps=10, loop=False, **kwargs):
+        """
+        Play the frames at `fps` (see Playback for the other options).
+        Returns the Playback controller.
+        """
         self.set_scene3d(0)
-        self.plotter.add_timer_event(
-            max_steps=self.num_frames, duration=2300,
-            callback=self.update_scene3d)
+        playback = Playback(
+            self, fps=fps, stop=self.num_frames, loop=loop, **kwargs)
+        playback.attach()
+        playback.play()
+        return playback
 
     def explore(self):
         self.plotter.show()
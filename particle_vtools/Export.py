@@ -0,0 +1,103 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines the export of an animated scene (fluid surfaces,
+particle glyphs and the static pore structure) to a ParaView time series:
+one PVD collection plus one VTK file per layer and frame.
+
+The entities are:
+- PVDExporter
+"""
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr
+
+
+class PVDExporter:
+    """
+    Streams frames into `<out_dir>/<name>.pvd`. Static geometry is written
+    once and referenced at every time step; frame files are produced in a
+    thread pool with at most `max_in_flight` frames in memory, written as
+    they complete and appended to the collection in order.
+    """
+    def __init__(self, out_dir, name="scene", n_workers=4,
+                 max_in_flight=None):
+        self.out_dir = out_dir
+        self.name = name
+        self.n_workers = n_workers
+        if max_in_flight is None:
+            max_in_flight = 2 * n_workers
+        self.max_in_flight = max_in_flight
+        self.static = []
+        os.makedirs(out_dir, exist_ok=True)
+
+    def mesh_path(self, layer, frame=None):
+        if frame is None:
+            return f"{self.name}_{layer}.vtp"
+        return f"{self.name}_{layer}_{frame:05d}.vtp"
+
+    def add_static(self, layer, mesh):
+        """
+        Write a mesh shown at every time step (e.g. the pore structure).
+        """
+        path = self.mesh_path(layer)
+        mesh.save(os.path.join(self.out_dir, path))
+        self.static.append((layer, path))
+
+    def _write_frame(self, layers, frame):
+        paths = []
+        for layer, iterator in layers:
+            mesh = iterator[frame]
+            if mesh.n_points == 0:
+                continue
+            path = self.mesh_path(layer, frame)
+            mesh.save(os.path.join(self.out_dir, path))
+            paths.append((layer, path))
+        return paths
+
+    def export(self, fluid_iterators=None, velocity_iterators=None,
+               pore_structure=None, frames=None, times=None):
+        """
+        Export the layers of an Explorer3D style scene. `frames` defaults
+        to the frames shared by all iterators, `times` to the frame index.
+        Returns the path of the PVD file.
+        """
+        layers = [(it.name, it) for it in (fluid_iterators or [])]
+        layers += [(it.name, it) for it in (velocity_iterators or [])]
+        if pore_structure is not None:
+            self.add_static("pore", pore_structure.get_surface())
+        if frames is None:
+            frames = range(min(len(it) for _, it in layers)) \
+                if layers else [0]
+        frames = list(frames)
+        if times is None:
+            times = frames
+        parts = {layer: part for part, layer in enumerate(
+            [layer for layer, _ in self.static] +
+            [layer for layer, _ in layers])}
+
+        pvd_path = os.path.join(self.out_dir, f"{self.name}.pvd")
+        with open(pvd_path, "w") as pvd, \
+                ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            pvd.write('<?xml version="1.0"?>\n'
+                      '<VTKFile type="Collection" version="0.1">\n'
+                      '  <Collection>\n')
+            pending = []
+            for frame, time in zip(frames, times):
+                pending.append((time, pool.submit(
+                    self._write_frame, layers, frame)))
+                if len(pending) >= self.max_in_flight:
+                    self._append(pvd, parts, *pending.pop(0))
+            for item in pending:
+                self._append(pvd, parts, *item)
+            pvd.write('  </Collection>\n</VTKFile>\n')
+        return pvd_path
+
+    def _append(self, pvd, parts, time, future):
+        entries = self.static + future.result()
+        for layer, path in entries:
+            pvd.write(f'    <DataSet timestep="{time}" '
+                      f'part="{parts[layer]}" file={quoteattr(path)}/>\n')
+        pvd.flush()
@@ -7,9 +7,18 @@ This file defines the entities that are used in the vtools package.
 The entities are:
 - FluidIterator
 """
+import os
+
+import numpy as np
+
 from abc import ABC, abstractmethod
-from skimage import io
-from .utils import tif_2_geo, geo_2_mesh
+from concurrent.futures import ThreadPoolExecutor
+from .SharedCache import SharedHandles
+from .utils import (
+    LazyModule, tif_2_geo, geo_2_mesh, mask_2_geo, stream_ordered,
+    tif_2_image)
+
+io = LazyModule("skimage.io")
 
 
 class FluidIterator(ABC):
@@ -45,23 +54,34 @@ class FluidIterator(ABC):
         """
         return self.get_surface(index)
 
-    def __iter__(self):
+    def get_frames(self):
         """
-        Returns an iterator that iterates over velocity fields.
+        The frame indices, in order.
         """
-        self._index = 0
-        return self
+        return range(len(self))
 
-    def __next__(self):
+    def iter_frames(self, start=None, stop=None, step=1, read_ahead=4,
+                    n_workers=2, load=None):
         """
-        Returns the next velocity field in the iteration.
+        Yield (index, surface) for the frames start <= index < stop, every
+        `step`-th, in order. Surfaces are read and meshed by `n_workers`
+        threads, keeping `read_ahead` frames ahead of the consumer.
+        `load` replaces the surface, e.g. load=iterator.get_volume.
         """
-        if self._index < len(self.fluid_files):
-            result = self.get_velocity_field(self._index)
-            self._index += 1
-            return result
-        else:
-            raise StopIteration
+        frames = [index for index in self.get_frames()
+                  if (start is None or index >= start) and
+                  (stop is None or index < stop)][::step]
+        if load is None:
+            load = self.__getitem__
+        return zip(frames, stream_ordered(
+            load, frames, read_ahead, n_workers))
+
+    def __iter__(self):
+        """
+        Iterates over the surfaces of all frames (see iter_frames).
+        """
+        for _, surface in self.iter_frames():
+            yield surface
 
 
 class FluidIterator_CT(FluidIterator):
@@ -74,7 +94,10 @@ class FluidIterator_CT(FluidIterator):
                  smooth_factor=0.5,
                  scale=None,
                  permute_axes=None,
-                 slicer=None):
+                 slicer=None,
+                 cache=False,
+                 shared_cache=None,
+                 masks=None):
         super().__init__(name)
         self.fluid_files = fluid_file_list
         self.threshold = threshold
@@ -84,31 +107,180 @@ class FluidIterator_CT(FluidIterator):
         self.scale = scale
         self.permute_axes = permute_axes
         self.slicer = slicer
+        # float32 verts / int32 faces and meshes per frame, keyed by frame
+        # index. With smooth_iter=0 the meshes wrap the cached arrays.
+        self.cache = cache
+        self._geo_cache = {}
+        self._surface_cache = {}
+        self._image_cache = {}
+        # SharedCache: volumes and verts / faces of the frames read are
+        # kept in shared memory (until release_shared) and pickle by name,
+        # so process pool workers attach to them
+        self.shared = None
+        if shared_cache is not None:
+            self.shared = SharedHandles(shared_cache)
+        # MaskSeries of the (sliced) frames at `threshold`: surfaces are
+        # extracted from the unpacked, down sampled masks
+        self.masks = masks
 
-    def get_geo(self, index):
-        # Read the TIFF file
+    def read_volume(self, index):
         tif_data = io.imread(self.fluid_files[index])
         if self.slicer:
             tif_data = tif_data[self.slicer]
-        # Convert the TIFF data to geometry (vertices and faces)
-        verts, faces = tif_2_geo(
-            tif_data,
-            threshold=self.threshold,
-            down_sample_factor=self.down_sample_factor,
-        )
+        return tif_data
+
+    def get_volume(self, index):
+        """
+        The (sliced) segmentation of a frame.
+        """
+        if self.shared is None:
+            return self.read_volume(index)
+        key = ("volume", os.path.abspath(self.fluid_files[index]),
+               repr(self.slicer))
+        return self.shared.get(key, lambda: self.read_volume(index))
+
+    def get_geo(self, index):
+        if index in self._geo_cache:
+            return self._geo_cache[index]
+        if self.shared is not None:
+            key = ("geo", os.path.abspath(self.fluid_files[index]),
+                   repr(self.slicer), self.threshold,
+                   self.down_sample_factor, self.scale, self.permute_axes)
+            geo = []
+
+            def load(part):
+                if not geo:
+                    geo.extend(self.compute_geo(index))
+                return geo[part]
+            verts = self.shared.get(key + ("verts",), lambda: load(0))
+            faces = self.shared.get(key + ("faces",), lambda: load(1))
+        else:
+            verts, faces = self.compute_geo(index)
+        if self.cache:
+            self._geo_cache[index] = (verts, faces)
+        return verts, faces
+
+    def compute_geo(self, index):
+        if self.masks is not None:
+            verts, faces = mask_2_geo(
+                self.masks.get_mask(index, step=self.down_sample_factor),
+                self.down_sample_factor)
+        else:
+            # Read the TIFF file
+            tif_data = self.get_volume(index)
+            # Convert the TIFF data to geometry (vertices and faces)
+            verts, faces = tif_2_geo(
+                tif_data,
+                threshold=self.threshold,
+                down_sample_factor=self.down_sample_factor,
+            )
         if self.scale:
             verts *= self.scale
         if self.permute_axes:
-            verts = verts[:, self.permute_axes]
+            # column indexing gives a non C-contiguous array
+            verts = np.ascontiguousarray(verts[:, self.permute_axes])
         return verts, faces
 
+    def get_image(self, index):
+        """
+        Down sampled label volume of a frame for volume rendering.
+        """
+        if index in self._image_cache:
+            return self._image_cache[index]
+        image = tif_2_image(
+            self.get_volume(index),
+            down_sample_factor=self.down_sample_factor,
+            scale=self.scale,
+            permute_axes=self.permute_axes)
+        if self.cache:
+            self._image_cache[index] = image
+        return image
+
+    def world_to_voxel(self, positions):
+        """
+        Nearest voxel index (N, 3) of positions given in mesh coordinates,
+        undoing `permute_axes` and `scale`.
+        """
+        coords = np.asarray(positions, dtype=np.float64)
+        if self.permute_axes:
+            coords = coords[:, np.argsort(self.permute_axes)]
+        if self.scale:
+            coords = coords / self.scale
+        return np.rint(coords).astype(np.int64)
+
+    def lookup_phase(self, volume, positions):
+        """
+        Segmentation value under each position, -1 outside the volume.
+        """
+        ijk = self.world_to_voxel(positions)
+        inside = np.all((ijk >= 0) & (ijk < volume.shape), axis=1)
+        labels = np.full(len(ijk), -1, dtype=np.int32)
+        labels[inside] = volume[tuple(ijk[inside].T)]
+        return labels
+
+    def get_phase(self, index, positions):
+        return self.lookup_phase(self.get_volume(index), positions)
+
+    def label_particles(self, particle_iterator, frames=None,
+                        frame_to_fluid=None, n_workers=4):
+        """
+        Phase label of every particle, in one parallel pass that reads
+        each segmentation once. Returns {frame: labels}, labels ordered
+        as particle_iterator.get_particle(frame).
+        frame_to_fluid maps a particle frame to a fluid index (identity
+        by default).
+        """
+        if frames is None:
+            frames = particle_iterator.get_frames()
+        if frame_to_fluid is None:
+            def frame_to_fluid(frame):
+                return frame
+
+        # particle frames sharing a fluid index share one volume read
+        frames = list(frames)
+        groups = {}
+        for frame in frames:
+            groups.setdefault(frame_to_fluid(frame), []).append(frame)
+
+        def label_group(item):
+            fluid_index, group = item
+            volume = self.get_volume(fluid_index)
+            return [
+                (frame, self.lookup_phase(
+                    volume, particle_iterator.get_particle(frame)[0]))
+                for frame in group]
+
+        labels = {}
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for group_labels in pool.map(label_group, groups.items()):
+                labels.update(group_labels)
+        return {frame: labels[frame] for frame in frames}
+
+    def release_shared(self):
+        """
+        Drop the references held in the SharedCache.
+        """
+        if self.shared is not None:
+            self.shared.release()
+
+    def cache_nbytes(self):
+        """
+        Memory held by the cached frame geometry, in bytes.
+        """
+        return sum(verts.nbytes + faces.nbytes
+                   for verts, faces in self._geo_cache.values())
+
     def get_surface(self, index):
+        if index in self._surface_cache:
+            return self._surface_cache[index]
         verts, faces = self.get_geo(index)
         # Convert the geometry into a mesh
         mesh_surface = geo_2_mesh(
             verts, faces,
             smooth_iter=self.smooth_iter,
             smooth_factor=self.smooth_factor)
+        if self.cache:
+            self._surface_cache[index] = mesh_surface
         return mesh_surface
 
     def __len__(self):
@@ -0,0 +1,142 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines iterators that insert interpolated frames between the
+(sparse in time) frames of existing fluid and particle iterators, for
+smoother animations.
+
+The entities are:
+- FluidIterator_Interpolated
+- ParticleIterator_Interpolated
+"""
+import numpy as np
+
+from .FluidStructure import FluidIterator
+from .Particle import ParticleIterator
+from .utils import LazyModule, geo_2_mesh
+
+pv = LazyModule("pyvista")
+ndimage = LazyModule("scipy.ndimage")
+measure = LazyModule("skimage.measure")
+
+
+def split_index(index, substeps):
+    """
+    Interpolated frame index -> (source frame position, blend weight).
+    """
+    return index // substeps, (index % substeps) / substeps
+
+
+class FluidIterator_Interpolated(FluidIterator):
+    """
+    Inserts `substeps - 1` surfaces between consecutive frames of a
+    FluidIterator_CT by blending the signed distance fields of the two
+    (down sampled) segmentations and remeshing the zero level set.
+    Distance fields and surfaces are computed lazily and cached.
+    """
+    def __init__(self, name, fluid_iterator, substeps=4, max_cached=8):
+        super().__init__(name)
+        self.fluid_iterator = fluid_iterator
+        self.substeps = substeps
+        self.max_cached = max_cached
+        self._sdf_cache = {}
+        self._surface_cache = {}
+
+    def get_sdf(self, frame):
+        """
+        Signed distance (in down sampled voxels) to the fluid surface,
+        negative inside the fluid.
+        """
+        if frame not in self._sdf_cache:
+            if len(self._sdf_cache) >= self.max_cached:
+                self._sdf_cache.pop(next(iter(self._sdf_cache)))
+            it = self.fluid_iterator
+            step = it.down_sample_factor
+            volume = it.get_volume(frame)
+            mask = volume[::step, ::step, ::step] == it.threshold
+            sdf = ndimage.distance_transform_edt(~mask) \
+                - ndimage.distance_transform_edt(mask)
+            self._sdf_cache[frame] = sdf.astype(np.float32)
+        return self._sdf_cache[frame]
+
+    def get_geo(self, index):
+        frame, alpha = split_index(index, self.substeps)
+        sdf = self.get_sdf(frame)
+        if alpha > 0:
+            sdf = (1 - alpha) * sdf + alpha * self.get_sdf(frame + 1)
+        if sdf.min() >= 0 or sdf.max() <= 0:
+            return (np.zeros((0, 3), dtype=np.float32),
+                    np.zeros((0, 3), dtype=np.int32))
+        verts, faces, _, _ = measure.marching_cubes(sdf, level=0)
+        it = self.fluid_iterator
+        verts = verts.astype(np.float32, copy=False)
+        verts *= it.down_sample_factor
+        if it.scale:
+            verts *= it.scale
+        if it.permute_axes:
+            verts = verts[:, it.permute_axes]
+        return verts, faces.astype(np.int32, copy=False)
+
+    def get_surface(self, index):
+        if index not in self._surface_cache:
+            if len(self._surface_cache) >= self.max_cached * self.substeps:
+                self._surface_cache.pop(next(iter(self._surface_cache)))
+            verts, faces = self.get_geo(index)
+            if len(faces) == 0:
+                mesh = pv.PolyData()
+            else:
+                mesh = geo_2_mesh(
+                    verts, faces,
+                    smooth_iter=self.fluid_iterator.smooth_iter,
+                    smooth_factor=self.fluid_iterator.smooth_factor)
+            self._surface_cache[index] = mesh
+        return self._surface_cache[index]
+
+    def __len__(self):
+        return (len(self.fluid_iterator) - 1) * self.substeps + 1
+
+
+class ParticleIterator_Interpolated(ParticleIterator):
+    """
+    Inserts `substeps - 1` frames between consecutive frames of a
+    ParticleIterator_DF by linear interpolation of position and velocity
+    along tracks (`id_key` column). Only particles present in both
+    frames are shown in between.
+    """
+    def __init__(self, name, particle_iterator, id_key='particle',
+                 substeps=4, **kwargs):
+        super().__init__(name, **kwargs)
+        self.particle_iterator = particle_iterator
+        self.id_key = id_key
+        self.substeps = substeps
+        self.frames = list(particle_iterator.get_frames())
+        self._cache = {}
+
+    def get_tracked(self, frame):
+        """
+        (ids, positions, velocities) of a source frame, sorted by id.
+        """
+        it = self.particle_iterator
+        ids = it.get_frame(frame)[self.id_key].to_numpy()
+        positions, velocities = it.get_particle(frame)
+        order = np.argsort(ids, kind='stable')
+        return ids[order], positions[order], velocities[order]
+
+    def get_particle(self, index):
+        if index in self._cache:
+            return self._cache[index]
+        k, alpha = split_index(index, self.substeps)
+        if alpha == 0:
+            return self.particle_iterator.get_particle(self.frames[k])
+        ids_a, pos_a, vel_a = self.get_tracked(self.frames[k])
+        ids_b, pos_b, vel_b = self.get_tracked(self.frames[k + 1])
+        _, ia, ib = np.intersect1d(
+            ids_a, ids_b, assume_unique=True, return_indices=True)
+        positions = (1 - alpha) * pos_a[ia] + alpha * pos_b[ib]
+        velocities = (1 - alpha) * vel_a[ia] + alpha * vel_b[ib]
+        self._cache = {index: (positions, velocities)}
+        return positions, velocities
+
+    def __len__(self):
+        return (len(self.frames) - 1) * self.substeps + 1
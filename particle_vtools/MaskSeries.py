@@ -0,0 +1,212 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines a compact store for the thresholded masks
+(volume == threshold) of a segmentation series: masks are bit packed along
+their last axis (8 voxels per byte), and frames between key frames are
+kept as the sparse XOR of their packed bytes against the previous frame.
+A series can be saved to a directory of .npy files and memory mapped back.
+
+The entities are:
+- MaskSeries
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MaskSeries:
+    """
+    Bit packed masks of a series of frames of `shape` (z, y, x).
+    Every `key_interval`-th frame is stored whole (key_interval=1: packed
+    only), the others as sparse deltas; a delta larger than
+    `max_delta` of the packed frame is stored as a key frame instead.
+    """
+    def __init__(self, shape, key_interval=8, max_delta=0.2):
+        self.shape = tuple(shape)
+        self.packed_shape = self.shape[:-1] + ((self.shape[-1] + 7) // 8,)
+        self.key_interval = key_interval
+        self.max_delta = max_delta
+        self.keys = []
+        # per frame: position in self.keys, or -1 and a (index, xor) delta
+        self.key_of = []
+        self.deltas = []
+        # the last frame decoded, (index, packed); decoding is serialised
+        # as frames are read from several threads (iter_frames, Playback)
+        self._last = (None, None)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_volumes(cls, volumes, threshold, key_interval=8, **kwargs):
+        series = None
+        for volume in volumes:
+            if series is None:
+                series = cls(volume.shape, key_interval, **kwargs)
+            series.append(volume == threshold)
+        return series
+
+    @classmethod
+    def from_iterator(cls, fluid_iterator, indices=None, key_interval=8,
+                      n_workers=4, **kwargs):
+        """
+        Masks of the (sliced) frames of a FluidIterator_CT at its
+        threshold; frames are read and packed in a thread pool.
+        """
+        if indices is None:
+            indices = range(len(fluid_iterator))
+
+        def pack(index):
+            volume = fluid_iterator.get_volume(index)
+            return volume.shape, np.packbits(
+                volume == fluid_iterator.threshold, axis=-1)
+
+        series = None
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for shape, packed in pool.map(pack, indices):
+                if series is None:
+                    series = cls(shape, key_interval, **kwargs)
+                series.append_packed(packed)
+        return series
+
+    def __len__(self):
+        return len(self.key_of)
+
+    def append(self, mask):
+        if mask.shape != self.shape:
+            raise ValueError(
+                f"Mask shape {mask.shape} does not match {self.shape}")
+        self.append_packed(np.packbits(mask, axis=-1))
+
+    def append_packed(self, packed):
+        index = len(self)
+        if index % self.key_interval != 0:
+            previous = self.get_packed(index - 1)
+            xor = np.bitwise_xor(previous, packed).ravel()
+            changed = np.flatnonzero(xor)
+            if changed.size <= self.max_delta * xor.size:
+                dtype = np.uint32 if xor.size < 2 ** 32 else np.int64
+                self.key_of.append(-1)
+                self.deltas.append(
+                    (changed.astype(dtype), xor[changed]))
+                self._remember(index, packed)
+                return
+        self.key_of.append(len(self.keys))
+        self.keys.append(packed)
+        self.deltas.append(None)
+        self._remember(index, packed)
+
+    def _remember(self, index, packed):
+        self._last = (index, packed)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_packed(self, index):
+        """
+        The packed bytes of a frame (z, y, ceil(x / 8)), rebuilt from the
+        closest key frame or from the last frame decoded.
+        """
+        if index < 0:
+            index += len(self)
+        with self._lock:
+            last, last_packed = self._last
+            if index == last:
+                return last_packed
+            start = index
+            while self.key_of[start] < 0:
+                start -= 1
+            if last is not None and start <= last < index:
+                # carry on from the last frame, e.g. when playing forwards
+                start = last
+                packed = last_packed.copy()
+            else:
+                packed = np.array(self.keys[self.key_of[start]])
+            flat = packed.reshape(-1)
+            for frame in range(start + 1, index + 1):
+                changed, xor = self.deltas[frame]
+                flat[changed] ^= xor
+            self._remember(index, packed)
+            return packed
+
+    def get_mask(self, index, region=None, step=1):
+        """
+        Boolean mask of a frame restricted to `region` (slices in (z, y, x)
+        order) and sampled every `step` voxels, as mask[region][::step,
+        ::step, ::step]. Only the bytes covering it are unpacked.
+        """
+        if region is None:
+            region = (slice(None),) * 3
+        (z0, z1, _), (y0, y1, _), (x0, x1, _) = [
+            axis.indices(n) for axis, n in zip(region, self.shape)]
+        packed = self.get_packed(index)
+        rows = packed[z0:z1:step, y0:y1:step]
+        first = x0 // 8
+        bits = np.unpackbits(rows[..., first:(x1 + 7) // 8], axis=-1)
+        offset = 8 * first
+        return bits[..., x0 - offset:x1 - offset:step].view(bool)
+
+    def nbytes(self):
+        return sum(key.nbytes for key in self.keys) + sum(
+            changed.nbytes + xor.nbytes
+            for changed, xor in filter(None, self.deltas))
+
+    def save(self, path):
+        """
+        Write the series to the directory `path` (see load).
+        """
+        os.makedirs(path, exist_ok=True)
+        keys = np.zeros((len(self.keys),) + self.packed_shape, np.uint8)
+        for i, key in enumerate(self.keys):
+            keys[i] = key
+        deltas = [delta for delta in self.deltas if delta is not None]
+        counts = [0 if delta is None else len(delta[0])
+                  for delta in self.deltas]
+        np.save(os.path.join(path, "keys.npy"), keys)
+        np.save(os.path.join(path, "key_of.npy"),
+                np.asarray(self.key_of, dtype=np.int64))
+        np.save(os.path.join(path, "delta_offsets.npy"),
+                np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        np.save(os.path.join(path, "delta_index.npy"), np.concatenate(
+            [changed for changed, _ in deltas] or [np.zeros(0, np.int64)]))
+        np.save(os.path.join(path, "delta_xor.npy"), np.concatenate(
+            [xor for _, xor in deltas] or [np.zeros(0, np.uint8)]))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"shape": self.shape,
+                       "key_interval": self.key_interval,
+                       "max_delta": self.max_delta}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Read a series written by save; with `mmap` the frames stay on
+        disk and only what is decoded is read.
+        """
+        mode = "r" if mmap else None
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        series = cls(meta["shape"], meta["key_interval"], meta["max_delta"])
+
+        def load_array(name):
+            return np.load(os.path.join(path, name), mmap_mode=mode)
+        keys = load_array("keys.npy")
+        series.keys = [keys[i] for i in range(len(keys))]
+        series.key_of = np.load(os.path.join(path, "key_of.npy")).tolist()
+        offsets = np.load(os.path.join(path, "delta_offsets.npy"))
+        changed = load_array("delta_index.npy")
+        xor = load_array("delta_xor.npy")
+        series.deltas = [
+            None if key >= 0 else (changed[start:stop], xor[start:stop])
+            for key, start, stop in zip(
+                series.key_of, offsets[:-1], offsets[1:])]
+        return series
@@ -5,22 +5,106 @@ Github: https://github.com/chunyang-w
 This file defines the entities that are used in the vtools package.
 
 The entities are:
+- MagnitudeStats
 - ParticleIterator
 """
-import pandas as pd
+import os
+
 import numpy as np
-import pyvista as pv
 
 from abc import ABC, abstractmethod
+from .Sampling import stratified_subsample
+from .SharedCache import SharedHandles
+from .SpatialIndex import IntersectionROI, build_tree
+from .utils import LazyModule, stream_ordered
+
+pd = LazyModule("pandas")
+pv = LazyModule("pyvista")
+
+
+class MagnitudeStats:
+    """
+    Global statistics of velocity magnitudes over a whole particle dataset.
+    Built in two streaming passes over chunks of magnitudes (min/max, then
+    a fixed-range histogram); quantiles are interpolated from the histogram.
+    """
+    def __init__(self, n_bins=1024):
+        self.n_bins = n_bins
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.hist = None
+        self.bin_edges = None
+
+    @classmethod
+    def from_chunks(cls, chunk_fn, n_bins=1024):
+        """
+        chunk_fn: callable returning a fresh iterable of magnitude arrays
+        """
+        stats = cls(n_bins)
+        for chunk in chunk_fn():
+            if len(chunk):
+                stats.min = min(stats.min, chunk.min())
+                stats.max = max(stats.max, chunk.max())
+        if stats.min > stats.max:
+            stats.min = stats.max = 0.0
+        stats.bin_edges = np.linspace(
+            stats.min, max(stats.max, stats.min + 1e-12), n_bins + 1)
+        stats.hist = np.zeros(n_bins, dtype=np.int64)
+        for chunk in chunk_fn():
+            hist, _ = np.histogram(chunk, bins=stats.bin_edges)
+            stats.hist += hist
+            stats.count += len(chunk)
+        return stats
+
+    @classmethod
+    def from_magnitudes(cls, magnitudes, n_bins=1024):
+        magnitudes = np.asarray(magnitudes).ravel()
+        return cls.from_chunks(lambda: [magnitudes], n_bins)
+
+    def quantile(self, q):
+        """
+        Approximate quantile(s), accurate to one histogram bin.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, self.min)
+        cdf = np.concatenate([[0], np.cumsum(self.hist)]) / self.count
+        return np.interp(q, cdf, self.bin_edges)
+
+    def clim(self, low=0.0, high=1.0):
+        """
+        Colour limits at the given quantiles, e.g. clim(0.2, 0.95).
+        """
+        return [float(v) for v in self.quantile([low, high])]
 
 
 class ParticleIterator(ABC):
     def __init__(self,
                  name,
                  arrow_lim=(0.1, 3),
+                 global_stats=False,
+                 particle_budget=None,
+                 budget_by_speed=False,
+                 max_trees=4,
                  ):
         self.name = name
         self.arrow_min, self.arrow_max = arrow_lim
+        # size arrows against the dataset-wide range instead of per frame
+        self.global_stats = global_stats
+        self.stats = None
+        # k-d trees of the max_trees frames used last (least recently used
+        # first), and the ROI applied by get_glyph
+        self.max_trees = max_trees
+        self._trees = {}
+        self.roi = None
+        # extra per-particle scalars, name -> fn(positions), and the
+        # point array the glyphs are coloured by
+        self.point_fields = {}
+        self.color_by = "mags"
+        # at most particle_budget glyphs per frame, stratified in space
+        self.particle_budget = particle_budget
+        self.budget_by_speed = budget_by_speed
 
     def compute_velocity_magnitudes(self, velocities):
         """
@@ -36,8 +120,13 @@ class ParticleIterator(ABC):
         If you just want to clamp, you can use np.clip directly.
         """
         # First find global min & max from your data or from magnitudes
-        mag_min = magnitudes.min()
-        mag_max = magnitudes.max()
+        if self.global_stats and self.stats is not None:
+            mag_min, mag_max = self.stats.min, self.stats.max
+        elif len(magnitudes) == 0:
+            return magnitudes
+        else:
+            mag_min = magnitudes.min()
+            mag_max = magnitudes.max()
         # Avoid division by zero
         denom = max(mag_max - mag_min, 1e-12)
 
@@ -52,15 +141,117 @@ class ParticleIterator(ABC):
     def get_particle(self, index):
         pass
 
-    def get_glyph(self, index):
+    def get_frames(self):
+        """
+        The frame indices accepted by get_particle, in order.
+        """
+        return range(len(self))
+
+    def get_tree(self, index):
+        """
+        k-d tree over the particle positions of a frame, kept for the
+        `max_trees` frames used last.
+        """
+        tree = self._trees.pop(index, None)
+        if tree is None:
+            positions, _ = self.get_particle(index)
+            tree = build_tree(positions)
+            while self._trees and len(self._trees) >= self.max_trees:
+                self._trees.pop(next(iter(self._trees)), None)
+        self._trees[index] = tree
+        return tree
+
+    def select_roi(self, index, roi):
+        """
+        Indices of the particles of a frame inside `roi` (all if None).
+        ROIs that only test positions (planes, frustum, fields) build no
+        tree.
+        """
+        if roi is None:
+            return slice(None)
+        if not roi.needs_tree:
+            positions, _ = self.get_particle(index)
+            return np.nonzero(roi.contains(positions))[0]
+        return roi.query(self.get_tree(index))
+
+    def get_particle_in_roi(self, index, roi):
+        """
+        Positions and velocities of the particles of a frame inside `roi`.
+        """
+        positions, velocities = self.get_particle(index)
+        idx = self.select_roi(index, roi)
+        return positions[idx], velocities[idx]
+
+    def get_point_data(self, index):
+        """
+        Extra per-particle arrays of a frame, attached to the glyphs.
+        """
+        return {}
+
+    def add_point_field(self, name, field_fn):
+        """
+        Attach a scalar computed from positions to every glyph, e.g.
+        add_point_field("wall_distance", pore_structure.wall_distance).
+        """
+        self.point_fields[name] = field_fn
+
+    def set_roi(self, roi):
+        """
+        Restrict the glyphs to a region of interest (None to clear).
+        """
+        self.roi = roi
+
+    def iter_magnitudes(self):
+        """
+        Yields the velocity magnitudes of the dataset chunk by chunk.
+        Defaults to one chunk per frame.
+        """
+        for index in self.get_frames():
+            _, velocities = self.get_particle(index)
+            yield self.compute_velocity_magnitudes(velocities)
+
+    def compute_statistics(self, n_bins=1024):
+        """
+        One-off statistics pass over all frames, stored on the iterator.
+        """
+        self.stats = MagnitudeStats.from_chunks(self.iter_magnitudes, n_bins)
+        return self.stats
+
+    def get_clim(self, low=0.0, high=1.0):
+        """
+        Dataset-wide colour limits at the given magnitude quantiles.
+        """
+        if self.stats is None:
+            self.compute_statistics()
+        return self.stats.clim(low, high)
+
+    def get_glyph(self, index, cull=None):
         """
         Abstract method that should return a mesh representing the pore
         surface.
+        `cull`: region outside of which a viewer could not see the glyphs
+        (view frustum / clip plane), applied together with the ROI.
         """
         arrow_min = self.arrow_min
         arrow_max = self.arrow_max
 
+        if self.global_stats and self.stats is None:
+            self.compute_statistics()
         positions, velocities = self.get_particle(index)
+        roi = self.roi
+        if cull is not None:
+            roi = IntersectionROI(self.roi, cull)
+        idx = np.arange(len(positions))[self.select_roi(index, roi)]
+        if self.particle_budget is not None:
+            weights = None
+            if self.budget_by_speed:
+                weights = self.compute_velocity_magnitudes(velocities[idx])
+            idx = idx[stratified_subsample(
+                positions[idx], self.particle_budget, weights=weights)]
+        positions, velocities = positions[idx], velocities[idx]
+        if len(positions) == 0:
+            # nothing in the frame / ROI
+            return pv.PolyData()
         magnitudes = self.compute_velocity_magnitudes(velocities)
         arrow_sizes = self.map_magnitudes_to_size(
             magnitudes, arrow_min, arrow_max)
@@ -72,8 +263,12 @@ class ParticleIterator(ABC):
         points['velocity'] = velocities
         points["mags"] = magnitudes            # For coloring
         points["arrowScale"] = arrow_sizes     # For sizing the glyphs
+        for name, field_fn in self.point_fields.items():
+            points[name] = field_fn(positions)
+        for name, values in self.get_point_data(index).items():
+            points[name] = values[idx]
 
-        points.set_active_scalars("mags")
+        points.set_active_scalars(self.color_by)
         print(points.active_scalars_name)
         arrow = pv.Arrow()
         glyphs = points.glyph(
@@ -82,7 +277,7 @@ class ParticleIterator(ABC):
             color_mode='scalar',
             factor=15,
             geom=arrow)
-        glyphs.set_active_scalars("mags")
+        glyphs.set_active_scalars(self.color_by)
         return glyphs
 
     @abstractmethod
@@ -98,23 +293,29 @@ class ParticleIterator(ABC):
         """
         return self.get_glyph(index)
 
-    def __iter__(self):
+    def iter_frames(self, start=None, stop=None, step=1, read_ahead=4,
+                    n_workers=2, load=None):
         """
-        Returns an iterator that iterates over velocity fields.
+        Yield (frame, glyphs) for the frames of get_frames() with
+        start <= frame < stop, every `step`-th, in order. Frames are
+        produced by `n_workers` threads, keeping `read_ahead` frames ahead
+        of the consumer. `load` replaces the glyphs, e.g.
+        load=iterator.get_particle streams (positions, velocities).
         """
-        self._index = 0
-        return self
+        frames = [frame for frame in self.get_frames()
+                  if (start is None or frame >= start) and
+                  (stop is None or frame < stop)][::step]
+        if load is None:
+            load = self.__getitem__
+        return zip(frames, stream_ordered(
+            load, frames, read_ahead, n_workers))
 
-    def __next__(self):
+    def __iter__(self):
         """
-        Returns the next velocity field in the iteration.
+        Iterates over the glyphs of all frames (see iter_frames).
         """
-        if self._index < len(self.fluid_files):
-            result = self.get_velocity_field(self._index)
-            self._index += 1
-            return result
-        else:
-            raise StopIteration
+        for _, glyphs in self.iter_frames():
+            yield glyphs
 
 
 class ParticleIterator_DF(ParticleIterator):
@@ -131,12 +332,21 @@ class ParticleIterator_DF(ParticleIterator):
                  shift_array=np.array([0, 0, 0]).reshape(-1, 3),
                  frame_start=0,
                  frame_end=10000,
+                 shared_cache=None,
                  **kwargs
                  ):
         super().__init__(name, **kwargs)
         self.df = pd.read_csv(df_path)
         self.df = self.df[(self.df[frame_key] >= frame_start) &
                           (self.df[frame_key] <= frame_end)]
+        # sort by frame once so a frame is a contiguous row range
+        self.df = self.df.sort_values(frame_key, kind='stable')
+        frames, starts, counts = np.unique(
+            self.df[frame_key].to_numpy(),
+            return_index=True, return_counts=True)
+        self._frame_rows = {
+            frame: (start, start + count)
+            for frame, start, count in zip(frames, starts, counts)}
         self.frame_key = frame_key
         self.shift = shift_array
         self.x_key = x_key
@@ -145,12 +355,92 @@ class ParticleIterator_DF(ParticleIterator):
         self.vx_key = vx_key
         self.vy_key = vy_key
         self.vz_key = vz_key
+        # extra columns attached to the glyphs, see set_column
+        self.data_keys = []
+        # SharedCache: the numeric columns live in shared memory and
+        # pickle by name, so process pool workers attach to the table
+        self.shared = None
+        self._shared_columns = {}
+        if shared_cache is not None:
+            self.share_table(shared_cache, (
+                "table", os.path.abspath(df_path), frame_key,
+                frame_start, frame_end))
+
+    def share_table(self, shared_cache, key):
+        self.shared = SharedHandles(shared_cache)
+        columns = {}
+        for column in self.df.columns:
+            values = self.df[column].to_numpy()
+            if values.dtype.kind in "biuf":
+                values = self.shared.get(
+                    key + (column,), lambda values=values: values)
+                if key + (column,) in self.shared.arrays:
+                    self._shared_columns[column] = key + (column,)
+            columns[column] = values
+        self.df = pd.DataFrame(columns, copy=False)
+
+    def release_shared(self):
+        """
+        Drop the references held in the SharedCache.
+        """
+        if self.shared is not None:
+            self.shared.release()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared is not None:
+            # the shared columns travel as block names, in self.shared
+            state["df"] = self.df.drop(columns=list(self._shared_columns))
+            state["_column_order"] = list(self.df.columns)
+        return state
+
+    def __setstate__(self, state):
+        column_order = state.pop("_column_order", None)
+        self.__dict__.update(state)
+        if column_order is None:
+            return
+        columns = {}
+        for column in column_order:
+            if column in self._shared_columns:
+                columns[column] = self.shared.arrays[
+                    self._shared_columns[column]]
+            else:
+                columns[column] = self.df[column].to_numpy()
+        self.df = pd.DataFrame(columns, copy=False)
 
     def __len__(self):
         return self.df[self.frame_key].nunique()
 
+    def get_frames(self):
+        return list(self._frame_rows)
+
+    def iter_magnitudes(self):
+        # the table is already in memory: one vectorised chunk
+        velocities = self.df[[self.vx_key, self.vy_key, self.vz_key]]
+        yield self.compute_velocity_magnitudes(velocities.to_numpy())
+
+    def set_column(self, name, values_by_frame):
+        """
+        Store per-particle values ({frame: array ordered as get_particle})
+        as a column and attach it to the glyphs, e.g. phase labels from
+        FluidIterator_CT.label_particles.
+        """
+        column = np.full(len(self.df), -1, dtype=np.result_type(
+            *[np.asarray(v).dtype for v in values_by_frame.values()]))
+        for frame, values in values_by_frame.items():
+            start, stop = self._frame_rows[frame]
+            column[start:stop] = values
+        self.df[name] = column
+        if name not in self.data_keys:
+            self.data_keys.append(name)
+
+    def get_point_data(self, index):
+        df_frame = self.get_frame(index)
+        return {key: df_frame[key].to_numpy() for key in self.data_keys}
+
     def get_frame(self, index):
-        df_frame = self.df[self.df[self.frame_key] == index].copy()
+        start, stop = self._frame_rows.get(index, (0, 0))
+        df_frame = self.df.iloc[start:stop].copy()
         return df_frame
 
     def get_particle(self, index):
@@ -0,0 +1,217 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines the playback of an Explorer3D scene at a requested frame
+rate: frames are chosen from the wall clock, the cost of showing a frame is
+measured, frames are skipped (or held) when the scene cannot keep up, and
+the next frames are loaded in a background thread when it can.
+
+The entities are:
+- Playback
+"""
+import math
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Playback:
+    """
+    Plays frames [start, stop) of `explorer` at `fps` frames per second,
+    times `speed`.
+
+    skip=True drops frames to stay on time when a frame takes longer than
+    1 / fps to show, skip=False shows every frame (playback slows down
+    instead). Frames are held on screen until their time comes. Up to
+    `prefetch` upcoming frames are loaded (Explorer3D.load_frame) in a
+    worker thread while the measured frame cost is below the frame
+    interval.
+    """
+    def __init__(self, explorer, fps=10, start=0, stop=None, speed=1.0,
+                 loop=True, skip=True, prefetch=2):
+        self.explorer = explorer
+        self.fps = fps
+        self.start = start
+        if stop is None:
+            stop = start + explorer.num_frames
+        self.stop = stop
+        self.speed = speed
+        self.loop = loop
+        self.skip = skip
+        self.prefetch = prefetch
+
+        self.playing = False
+        self.frame = explorer.frame_idx
+        # fractional frame position on the play clock
+        self.position = float(self.frame)
+        self.last_tick = None
+        # exponential moving average of the time to show a frame (s)
+        self.frame_cost = 0.0
+        self.n_shown = 0
+        self.n_skipped = 0
+        self._pool = None
+        self._pending = {}
+        self._timer_id = None
+
+    @property
+    def interval(self):
+        """
+        Time between frames on the play clock (s).
+        """
+        if self.speed == 0:
+            return float("inf")
+        return 1.0 / (self.fps * abs(self.speed))
+
+    def attach(self, keys=True):
+        """
+        Drive the playback from a repeating timer of the plotter window and
+        bind the keys: space play/pause, Right/Left step, Up/Down speed,
+        l loop on/off.
+        """
+        iren = self.explorer.plotter.iren
+        if iren is None:
+            # off screen: call tick() yourself
+            return
+        iren.add_observer("TimerEvent", lambda *args: self.tick())
+        # tick faster than the frame rate, frames are picked by the clock
+        self._timer_id = iren.create_timer(
+            max(1, int(500 / self.fps)), repeating=True)
+        if keys:
+            iren.add_key_event("space", self.toggle)
+            iren.add_key_event("Right", lambda: self.step(1))
+            iren.add_key_event("Left", lambda: self.step(-1))
+            iren.add_key_event("Up", lambda: self.set_speed(self.speed * 2))
+            iren.add_key_event("Down", lambda: self.set_speed(self.speed / 2))
+            iren.add_key_event("l", self.toggle_loop)
+
+    def play(self):
+        # the clock starts at the first tick, e.g. once the window is up
+        self.playing = True
+        self.last_tick = None
+
+    def pause(self):
+        self.playing = False
+
+    def toggle(self):
+        if self.playing:
+            self.pause()
+        else:
+            self.play()
+
+    def toggle_loop(self):
+        self.loop = not self.loop
+
+    def set_speed(self, speed):
+        """
+        Play clock speed (negative plays backwards).
+        """
+        self.speed = speed
+        self._clear_pending()
+
+    def seek(self, frame):
+        self.position = float(frame)
+        self._clear_pending()
+        self.show(int(frame))
+
+    def step(self, n=1):
+        """
+        Pause and move `n` frames.
+        """
+        self.pause()
+        self.seek(self._wrap(self.frame + n))
+
+    def tick(self, now=None):
+        """
+        Advance the play clock and show the frame it points at; frames
+        between the last shown one and it are skipped. Returns the frame
+        shown, None if the current frame is held.
+        """
+        if not self.playing:
+            return None
+        if now is None:
+            now = time.perf_counter()
+        if self.last_tick is None:
+            self.last_tick = now
+        self.position += (now - self.last_tick) * self.fps * self.speed
+        self.last_tick = now
+        direction = 1 if self.speed > 0 else -1
+        # the frame reached so far in the play direction; the tolerance
+        # absorbs the rounding of the accumulated clock
+        if direction > 0:
+            target = math.floor(self.position + 1e-9)
+        else:
+            target = math.ceil(self.position - 1e-9)
+        if (target - self.frame) * direction <= 0:
+            return None
+        if not self.skip:
+            # hold the clock at the next frame rather than dropping any
+            target = self.frame + direction
+            self.position = float(target)
+        else:
+            self.n_skipped += abs(target - self.frame) - 1
+        if not self.start <= target < self.stop:
+            if not self.loop:
+                self.pause()
+                return None
+            target = self._wrap(target)
+            self.position = float(target)
+        self.show(target)
+        return target
+
+    def show(self, frame):
+        started = time.perf_counter()
+        future = self._pending.pop(frame, None)
+        # a frame being prefetched is waited for rather than recomputed
+        frame_data = future.result() if future is not None else None
+        self.explorer.update_scene3d(frame, frame_data)
+        self.explorer.plotter.render()
+        cost = time.perf_counter() - started
+        self.frame_cost = cost if self.n_shown == 0 else \
+            0.8 * self.frame_cost + 0.2 * cost
+        self.frame = frame
+        self.n_shown += 1
+        if self.playing:
+            self._prefetch(frame)
+
+    def _wrap(self, frame):
+        return self.start + (frame - self.start) % (self.stop - self.start)
+
+    def _prefetch(self, frame):
+        direction = 1 if self.speed > 0 else -1
+        upcoming = []
+        for k in range(1, self.prefetch + 1):
+            next_frame = frame + k * direction
+            if not self.start <= next_frame < self.stop:
+                if not self.loop:
+                    break
+                next_frame = self._wrap(next_frame)
+            upcoming.append(next_frame)
+        # drop frames the clock has passed
+        for pending in list(self._pending):
+            if pending not in upcoming:
+                self._pending.pop(pending).cancel()
+        if self.frame_cost >= self.interval:
+            # behind: the frames would be skipped before they are used
+            return
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        for next_frame in upcoming:
+            if next_frame not in self._pending:
+                self._pending[next_frame] = self._pool.submit(
+                    self.explorer.load_frame, next_frame)
+
+    def _clear_pending(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+
+    def close(self):
+        self.pause()
+        self._clear_pending()
+        if self._timer_id is not None:
+            self.explorer.plotter.iren.destroy_timer(self._timer_id)
+            self._timer_id = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
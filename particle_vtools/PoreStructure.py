@@ -9,10 +9,16 @@ The entities are:
 - FluidIterator
 - ParticleIterator
 """
+import os
+
+import numpy as np
+
 from abc import ABC, abstractmethod
-from skimage import io
-from sklearn.preprocessing import normalize
-from .utils import tif_2_geo, geo_2_mesh
+from .SharedCache import SharedHandles
+from .utils import LazyModule, tif_2_geo, geo_2_mesh, tif_2_image
+
+ndimage = LazyModule("scipy.ndimage")
+io = LazyModule("skimage.io")
 
 
 class PoreStructure(ABC):
@@ -51,8 +57,18 @@ class PoreStructure_CT(PoreStructure):
                  scale=None,
                  expand_distance=10,
                  permute_axes=None,
-                 slicer=None):
-        self.tif_data = io.imread(tif_file)
+                 slicer=None,
+                 shared_cache=None):
+        self.tif_file = os.path.abspath(tif_file)
+        # with a SharedCache the volume (and distance field) live in shared
+        # memory and pickle by name, e.g. when sent to a process pool
+        self.shared = None
+        if shared_cache is not None:
+            self.shared = SharedHandles(shared_cache)
+            self.tif_data = self.shared.get(
+                ("volume", self.tif_file), lambda: io.imread(tif_file))
+        else:
+            self.tif_data = io.imread(tif_file)
         self.threshold = threshold
         self.down_sample_factor = down_sample_factor
         self.smooth_iter = smooth_iter
@@ -61,13 +77,22 @@ class PoreStructure_CT(PoreStructure):
         self.permute_axes = permute_axes
         self.slicer = slicer
         self.expand_distance = expand_distance
+        # Euclidean distance transform to the pore wall, built on demand
+        self.distance_field = None
+        self.distance_step = None
+
+    def get_volume(self):
+        """
+        The (sliced) segmentation the surface is extracted from.
+        """
+        if self.slicer:
+            return self.tif_data[self.slicer]
+        return self.tif_data
 
     def get_geo(self):
         # Convert the TIFF data to geometry (vertices and faces)
-        if self.slicer:
-            self.tif_data = self.tif_data[self.slicer]
         verts, faces = tif_2_geo(
-            self.tif_data,
+            self.get_volume(),
             threshold=self.threshold,
             down_sample_factor=self.down_sample_factor
         )
@@ -86,3 +111,79 @@ class PoreStructure_CT(PoreStructure):
         mesh = mesh_surface
 
         return mesh
+
+    def get_image(self):
+        """
+        Down sampled label volume for volume rendering.
+        """
+        return tif_2_image(
+            self.get_volume(),
+            down_sample_factor=self.down_sample_factor,
+            scale=self.scale,
+            permute_axes=self.permute_axes)
+
+    def get_distance_field(self, down_sample_factor=None, signed=False):
+        """
+        Euclidean distance (in scaled units) from every voxel of the
+        (down sampled) segmentation to the wall, i.e. the boundary of the
+        `tif == threshold` phase. With `signed`, voxels of that phase are
+        negative. The field is computed once and kept on the instance.
+        """
+        if down_sample_factor is None:
+            down_sample_factor = self.down_sample_factor
+        step = down_sample_factor
+        if self.shared is not None:
+            key = ("distance", self.tif_file, repr(self.slicer),
+                   self.threshold, step, self.scale, signed)
+            self.distance_field = self.shared.get(
+                key, lambda: self.compute_distance_field(step, signed))
+        else:
+            self.distance_field = self.compute_distance_field(step, signed)
+        self.distance_step = step
+        return self.distance_field
+
+    def compute_distance_field(self, step, signed):
+        mask = self.get_volume()[::step, ::step, ::step] == self.threshold
+        scale = 1 if self.scale is None else self.scale
+        sampling = step * np.broadcast_to(np.asarray(scale, float), (3,))
+        outside = ndimage.distance_transform_edt(~mask, sampling=sampling)
+        inside = ndimage.distance_transform_edt(mask, sampling=sampling)
+        # the EDT runs between voxel centres; the wall (the mesh surface)
+        # lies half a voxel from the centres on either side of it
+        half = 0.5 * sampling.min()
+        outside = np.where(mask, 0, outside - half)
+        inside = np.where(mask, inside - half, 0)
+        if signed:
+            field = outside - inside
+        else:
+            field = outside + inside
+        return field.astype(np.float32)
+
+    def release_shared(self):
+        """
+        Drop the references held in the SharedCache.
+        """
+        if self.shared is not None:
+            self.shared.release()
+
+    def world_to_grid(self, positions):
+        """
+        Map positions in mesh coordinates onto distance field indices,
+        undoing `permute_axes` and `scale`.
+        """
+        coords = np.asarray(positions, dtype=np.float64)
+        if self.permute_axes:
+            coords = coords[:, np.argsort(self.permute_axes)]
+        if self.scale:
+            coords = coords / self.scale
+        return coords / self.distance_step
+
+    def wall_distance(self, positions):
+        """
+        Trilinear lookup of the wall distance at positions (N, 3).
+        """
+        if self.distance_field is None:
+            self.get_distance_field()
+        coords = self.world_to_grid(positions)
+        return ndimage.map_coordinates(
+            self.distance_field, coords.T, order=1, mode='nearest')
@@ -0,0 +1,96 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines reproducible, spatially stratified subsampling of
+particles and tracks under a fixed rendering budget.
+
+The entities are:
+- default_cell_size
+- stratified_subsample
+- subsample_tracks
+"""
+import numpy as np
+
+
+def default_cell_size(extent, budget):
+    """
+    Cube size giving about `budget` cells over a box of `extent`. Axes
+    thinner than a cell would hold a single layer, so they are left out
+    and the size is taken over the remaining axes only.
+    """
+    extent = np.asarray(extent, dtype=np.float64)
+    axes = np.ones(len(extent), dtype=bool)
+    while True:
+        dim = int(np.count_nonzero(axes))
+        cell_size = (np.prod(extent[axes]) / budget) ** (1 / dim)
+        thin = axes & (extent < cell_size)
+        if not thin.any() or dim == 1:
+            return cell_size
+        axes &= ~thin
+
+
+def stratified_subsample(positions, budget, cell_size=None, weights=None,
+                         seed=0):
+    """
+    Indices of at most `budget` points spread over a uniform grid.
+    Points are taken round-robin over the occupied grid cells, so sparse
+    regions keep their points while dense clusters are thinned. Within a
+    cell the order is random (seeded), or weighted by `weights` (e.g.
+    speed) using weighted random keys. The default cell size gives about
+    `budget` cells over the bounding box, counted over the axes the
+    points spread along (flat or thin sets are gridded in 2D / 1D).
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    n = len(positions)
+    if budget >= n:
+        return np.arange(n)
+    if budget <= 0:
+        return np.zeros(0, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    lower = positions.min(axis=0)
+    extent = np.maximum(positions.max(axis=0) - lower, 1e-12)
+    if cell_size is None:
+        cell_size = default_cell_size(extent, budget)
+    ijk = np.floor((positions - lower) / cell_size).astype(np.int64)
+    _, cell = np.unique(ijk, axis=0, return_inverse=True)
+    cell = cell.ravel()
+
+    u = rng.random(n)
+    if weights is None:
+        key = u
+    else:
+        # Efraimidis-Spirakis: larger weights tend to come first
+        w = np.maximum(np.asarray(weights, dtype=np.float64), 1e-12)
+        key = -np.log(u) / w
+    # rank of each point inside its cell
+    order = np.lexsort((key, cell))
+    sorted_cell = cell[order]
+    starts = np.r_[0, np.nonzero(np.diff(sorted_cell))[0] + 1]
+    counts = np.diff(np.r_[starts, n])
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n) - np.repeat(starts, counts)
+    # round robin: all rank 0 points (cells in random order), then rank 1
+    cell_order = rng.permutation(cell.max() + 1)
+    pick = np.lexsort((cell_order[cell], rank))[:budget]
+    return np.sort(pick)
+
+
+def subsample_tracks(df, budget, id_key='particle_id', x_key='x', y_key='y',
+                     z_key='z', speed_key=None, seed=0):
+    """
+    Keep at most `budget` tracks of a particle DataFrame, stratified on
+    the mean position of each track (optionally weighted by the mean of
+    `speed_key`). Returns the filtered DataFrame.
+    """
+    columns = [x_key, y_key, z_key]
+    if speed_key is not None:
+        columns.append(speed_key)
+    per_track = df.groupby(id_key)[columns].mean()
+    weights = None
+    if speed_key is not None:
+        weights = per_track[speed_key].to_numpy()
+    keep = stratified_subsample(
+        per_track[[x_key, y_key, z_key]].to_numpy(), budget,
+        weights=weights, seed=seed)
+    return df[df[id_key].isin(per_track.index[keep])]
@@ -0,0 +1,305 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines a cache of numpy arrays (volumes, vertex / face arrays,
+particle table columns) in named shared memory blocks. Arrays from the
+cache pickle as the name of their block, so process pool workers attach to
+the parent's copy instead of re-reading files or receiving pickled copies.
+
+The entities are:
+- SharedArray
+- SharedCache
+- SharedHandles
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from multiprocessing import resource_tracker, shared_memory
+
+# a block starts with a json header (dtype, shape) padded to HEADER_SIZE;
+# its last byte is set once the data is written
+HEADER_SIZE = 256
+READY = 1
+
+# blocks mapped by this process, by name: a mapping must outlive every
+# array viewing it, so blocks are only closed when nothing views them
+_blocks = {}
+# names of the blocks this process created (and must unlink)
+_created = set()
+# mappings dropped while arrays still viewed them, closed later
+_retired = []
+# guards _blocks and, before Python 3.13, the resource tracker patch
+_lock = threading.RLock()
+# a forked child inherits the mappings but created none of the blocks
+os.register_at_fork(after_in_child=_created.clear)
+
+
+class SharedArray(np.ndarray):
+    """
+    Read-only array viewing a whole shared memory block. Pickles as the
+    block name; views and computation results pickle as plain arrays.
+    """
+    def __array_finalize__(self, obj):
+        self.block_name = None
+
+    def __reduce__(self):
+        if self.block_name is None:
+            return np.asarray(self).__reduce__()
+        return attach, (self.block_name,)
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+
+def _open_block(name):
+    with _lock:
+        shm = _blocks.get(name)
+        if shm is not None:
+            return shm
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # attached blocks are registered with the resource tracker,
+            # which unlinks them when this process exits: only the creator
+            # may. The patch is global, so creating blocks waits for it.
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args: None
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+        _blocks[name] = shm
+        return shm
+
+
+def _close(shm):
+    """
+    Unmap a block, or retire it while arrays of this process view it.
+    """
+    try:
+        shm.close()
+    except BufferError:
+        _retired.append(shm)
+
+
+def _sweep():
+    # close the retired mappings nothing views any more
+    retired = list(_retired)
+    _retired.clear()
+    for shm in retired:
+        _close(shm)
+
+
+def _view(shm):
+    dtype, shape = json.loads(bytes(shm.buf[:HEADER_SIZE - 1]))
+    array = np.ndarray(
+        shape, dtype=dtype, buffer=shm.buf, offset=HEADER_SIZE).view(
+            SharedArray)
+    array.block_name = shm.name.lstrip("/")
+    # other processes see the same memory
+    array.flags.writeable = False
+    return array
+
+
+def attach(name, timeout=30.0):
+    """
+    The array of an existing block (FileNotFoundError if there is none),
+    waiting for its creator to finish writing it.
+    """
+    shm = _open_block(name)
+    deadline = time.monotonic() + timeout
+    while shm.buf[HEADER_SIZE - 1] != READY:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Shared block {name} was never written")
+        time.sleep(0.001)
+    return _view(shm)
+
+
+def create(name, array):
+    """
+    Copy `array` into a new block (FileExistsError if it exists).
+    """
+    array = np.ascontiguousarray(array)
+    header = json.dumps([array.dtype.str, array.shape]).encode()
+    if len(header) >= HEADER_SIZE:
+        raise ValueError(f"Array header too long: {header}")
+    with _lock:
+        shm = shared_memory.SharedMemory(
+            name=name, create=True, size=HEADER_SIZE + array.nbytes)
+        _blocks[name] = shm
+        _created.add(name)
+    shm.buf[:len(header)] = header
+    shm.buf[len(header):HEADER_SIZE - 1] = b" " * (
+        HEADER_SIZE - 1 - len(header))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf,
+               offset=HEADER_SIZE)[...] = array
+    shm.buf[HEADER_SIZE - 1] = READY
+    return _view(shm)
+
+
+def unlink(name):
+    """
+    Remove a block created by this process. Processes still attached keep
+    their mapping until they drop it.
+    """
+    with _lock:
+        shm = _blocks.pop(name, None)
+        if shm is None:
+            return
+        _created.discard(name)
+        shm.unlink()
+        _close(shm)
+        _sweep()
+
+
+def detach(name):
+    """
+    Unmap a block attached by this process once its arrays are dropped;
+    the block itself stays for the processes using it.
+    """
+    with _lock:
+        if name in _created:
+            # another cache of this process created it and unlinks it
+            return
+        shm = _blocks.pop(name, None)
+        if shm is not None:
+            _close(shm)
+        _sweep()
+
+
+class SharedCache:
+    """
+    Reference counted shared arrays by key. A key maps to the same block
+    name in every process, so another cache on the machine attaches to a
+    block instead of loading its own copy. The cache that created a block
+    unlinks it when its last reference is released.
+
+    A cache pickled to a worker process only attaches: arrays that are
+    not shared yet are loaded there as private arrays.
+    """
+    def __init__(self, prefix="pvt"):
+        # block names are prefix_<hash>; keep them short (macOS: 31 chars)
+        self.prefix = prefix
+        self.pid = os.getpid()
+        self.entries = {}
+        self.owned = set()
+
+    def __getstate__(self):
+        return {"prefix": self.prefix, "pid": self.pid}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.entries = {}
+        self.owned = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.clear()
+
+    def block_name(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+        return f"{self.prefix}_{digest}"
+
+    def acquire(self, key, loader):
+        """
+        The shared array of `key`, created from `loader()` if no process
+        has it yet. Each call takes a reference, see release().
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            array = self._load(key, loader)
+            if not isinstance(array, SharedArray):
+                return array
+            entry = self.entries[key] = [array, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _load(self, key, loader):
+        name = self.block_name(key)
+        try:
+            return attach(name)
+        except FileNotFoundError:
+            pass
+        array = loader()
+        if os.getpid() != self.pid:
+            return array
+        try:
+            shared = create(name, array)
+        except FileExistsError:
+            # another process created it in the meantime
+            return attach(name)
+        self.owned.add(name)
+        return shared
+
+    def release(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del self.entries[key]
+        name = self.block_name(key)
+        if name in self.owned and os.getpid() == self.pid:
+            self.owned.discard(name)
+            unlink(name)
+        else:
+            # attached: unmap it, or an unlinked block stays pinned for
+            # the life of this process
+            detach(name)
+
+    def clear(self):
+        """
+        Drop every reference (and the blocks this cache created).
+        """
+        for key in list(self.entries):
+            self.entries[key][1] = 1
+            self.release(key)
+
+    def nbytes(self):
+        return sum(array.nbytes for array, _ in self.entries.values())
+
+
+class SharedHandles:
+    """
+    The arrays one object (an iterator, a pore structure) holds in a
+    SharedCache, one reference per key. Pickles with its arrays, so the
+    receiving process attaches to them by name.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.arrays = {}
+        self._held = set()
+
+    def __getstate__(self):
+        return {"cache": self.cache, "arrays": self.arrays}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._held = set()
+
+    def get(self, key, loader):
+        array = self.arrays.get(key)
+        if array is None:
+            array = self.cache.acquire(key, loader)
+            if isinstance(array, SharedArray):
+                self.arrays[key] = array
+                self._held.add(key)
+        return array
+
+    def release(self):
+        held = self._held
+        # drop the arrays first so the mappings can be closed
+        self._held = set()
+        self.arrays = {}
+        for key in held:
+            self.cache.release(key)
@@ -0,0 +1,226 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines the 2D slicers used to explore the internal structure
+of the porous media: linked axial / coronal / sagittal panes over a time
+series of segmented (or grayscale) volumes, with the particles of a thin
+slab around each plane overlaid.
+
+Volumes are never read as a whole: uncompressed TIFFs are memory mapped,
+axial planes of compressed TIFFs are read page by page, and other planes
+of compressed TIFFs come from a one-off .npy conversion that is memory
+mapped afterwards.
+
+The entities are:
+- LazyVolume
+- SliceViewer
+"""
+import os
+
+import numpy as np
+import pyvista as pv
+import tifffile
+
+
+class LazyVolume:
+    """
+    Plane access to a 3D TIFF without loading it into memory.
+    """
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._array = None
+        try:
+            self._array = tifffile.memmap(path, mode='r')
+        except ValueError:
+            # compressed / non contiguous data
+            pass
+        with tifffile.TiffFile(path) as tif:
+            self.shape = tuple(tif.series[0].shape)
+            self.dtype = tif.series[0].dtype
+
+    def _chunked(self):
+        """
+        Memory mapped .npy copy of the volume, converted page by page.
+        """
+        if self._array is None:
+            cache_dir = self.cache_dir or os.path.dirname(self.path)
+            npy_path = os.path.join(
+                cache_dir, os.path.basename(self.path) + ".npy")
+            if not os.path.exists(npy_path):
+                out = np.lib.format.open_memmap(
+                    npy_path, mode='w+', dtype=self.dtype, shape=self.shape)
+                with tifffile.TiffFile(self.path) as tif:
+                    for i, page in enumerate(tif.pages[:self.shape[0]]):
+                        out[i] = page.asarray()
+                out.flush()
+                del out
+            self._array = np.load(npy_path, mmap_mode='r')
+        return self._array
+
+    def get_slice(self, axis, index):
+        """
+        The 2D plane `index` along `axis` (0: axial, 1: coronal,
+        2: sagittal) of the volume, in index order.
+        """
+        if self._array is None and axis == 0:
+            with tifffile.TiffFile(self.path) as tif:
+                return tif.pages[index].asarray()
+        array = self._chunked()
+        return np.asarray(np.take(array, index, axis=axis))
+
+
+class SliceViewer:
+    """
+    Three linked orthogonal slice panes over a series of volume files.
+    Slice positions and the frame are driven by sliders (or set_slice /
+    set_frame); only the displayed planes are read. Particles of
+    `particle_iterator` within `slab` voxels of a plane are drawn on it,
+    after mapping them into volume indices (undoing permute_axes and
+    scale, as for FluidIterator_CT).
+    """
+    AXES = ("axial", "coronal", "sagittal")
+
+    def __init__(self,
+                 volume_files,
+                 particle_iterator=None,
+                 scale=None,
+                 permute_axes=None,
+                 slab=2,
+                 cmap="gray",
+                 clim=None,
+                 particle_color="red",
+                 plotter=None,
+                 subplots=((0, 0), (0, 1), (0, 2)),
+                 cache_dir=None):
+        self.volume_files = volume_files
+        self.particle_iterator = particle_iterator
+        self.scale = scale
+        self.permute_axes = permute_axes
+        self.slab = slab
+        self.cmap = cmap
+        self.particle_color = particle_color
+        self.cache_dir = cache_dir
+        self.plotter = plotter
+        if self.plotter is None:
+            self.plotter = pv.Plotter(
+                shape=(1, 3), window_size=[1800, 600],
+                title="Particle-vtools (Slice Viewer)")
+        self.subplots = subplots
+        self._volumes = {}
+        self.frame_idx = 0
+        volume = self.get_volume(0)
+        self.shape = volume.shape
+        self.indices = [n // 2 for n in self.shape]
+        if clim is None:
+            clim = [0, np.iinfo(volume.dtype).max
+                    if np.issubdtype(volume.dtype, np.integer) else 1]
+        self.clim = clim
+        self.images = []
+        self.points = []
+        self.point_actors = []
+        self._particle_voxels = None
+
+    def get_volume(self, frame):
+        if frame not in self._volumes:
+            # keep a handful of memory maps open
+            if len(self._volumes) >= 4:
+                self._volumes.pop(next(iter(self._volumes)))
+            self._volumes[frame] = LazyVolume(
+                self.volume_files[frame], self.cache_dir)
+        return self._volumes[frame]
+
+    def world_to_voxel(self, positions):
+        coords = np.asarray(positions, dtype=np.float64)
+        if self.permute_axes:
+            coords = coords[:, np.argsort(self.permute_axes)]
+        if self.scale:
+            coords = coords / self.scale
+        return coords
+
+    def _plane_axes(self, axis):
+        return [a for a in range(3) if a != axis]
+
+    def _particles_on_plane(self, axis):
+        voxels = self._particle_voxels
+        if voxels is None or len(voxels) == 0:
+            return np.zeros((0, 3))
+        near = np.abs(voxels[:, axis] - self.indices[axis]) <= self.slab
+        u, v = self._plane_axes(axis)
+        on_plane = np.zeros((int(near.sum()), 3))
+        on_plane[:, 0] = voxels[near, u]
+        on_plane[:, 1] = voxels[near, v]
+        on_plane[:, 2] = 0.5
+        return on_plane
+
+    def _update_points(self, axis):
+        on_plane = self._particles_on_plane(axis)
+        actor = self.point_actors[axis]
+        if len(on_plane) == 0:
+            actor.SetVisibility(False)
+            return
+        self.points[axis].copy_from(pv.PolyData(on_plane))
+        actor.SetVisibility(True)
+
+    def _update_image(self, axis):
+        plane = self.get_volume(self.frame_idx).get_slice(
+            axis, self.indices[axis])
+        # x (first plane axis) runs fastest in VTK
+        self.images[axis].point_data['value'] = plane.ravel(order='F')
+
+    def set_scene(self):
+        for axis in range(3):
+            self.plotter.subplot(*self.subplots[axis])
+            u, v = self._plane_axes(axis)
+            image = pv.ImageData(
+                dimensions=(self.shape[u], self.shape[v], 1))
+            self.images.append(image)
+            self._update_image(axis)
+            self.plotter.add_mesh(
+                image, scalars='value', cmap=self.cmap, clim=self.clim,
+                show_scalar_bar=False)
+            points = pv.PolyData(np.zeros((1, 3)))
+            self.points.append(points)
+            self.point_actors.append(self.plotter.add_mesh(
+                points, color=self.particle_color, point_size=6,
+                render_points_as_spheres=True))
+            self.plotter.add_text(self.AXES[axis], font_size=12)
+            self.plotter.view_xy()
+            self.plotter.add_slider_widget(
+                lambda value, axis=axis: self.set_slice(axis, value),
+                [0, self.shape[axis] - 1], value=self.indices[axis],
+                title=f"{self.AXES[axis]} slice",
+                pointa=(0.1, 0.9), pointb=(0.9, 0.9))
+        self.set_frame(self.frame_idx)
+
+    def set_slice(self, axis, index):
+        self.indices[axis] = int(index)
+        self._update_image(axis)
+        self._update_points(axis)
+
+    def set_frame(self, frame_idx):
+        self.frame_idx = int(frame_idx)
+        if self.particle_iterator is not None:
+            positions, _ = self.particle_iterator.get_particle(
+                self.frame_idx)
+            self._particle_voxels = self.world_to_voxel(positions)
+        for axis in range(3):
+            self._update_image(axis)
+            self._update_points(axis)
+
+    def link(self, explorer):
+        """
+        Follow the frame of an Explorer3D.
+        """
+        explorer.frame_callbacks.append(self.set_frame)
+
+    def set_time_slider(self):
+        self.plotter.subplot(*self.subplots[0])
+        self.plotter.add_slider_widget(
+            self.set_frame, [0, len(self.volume_files) - 1],
+            value=self.frame_idx, title='Frame',
+            pointa=(0.1, 0.1), pointb=(0.9, 0.1))
+
+    def explore(self):
+        self.plotter.show()
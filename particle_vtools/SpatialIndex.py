@@ -0,0 +1,186 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines the region-of-interest (ROI) queries used to select
+particles, from a per-frame k-d tree or, for regions tested point by
+point, from the positions directly.
+
+The entities are:
+- ROI
+- BoxROI
+- SphereROI
+- HalfSpaceROI
+- FieldROI
+- FrustumROI
+- IntersectionROI
+"""
+import numpy as np
+
+from abc import ABC, abstractmethod
+from .utils import LazyModule
+
+spatial = LazyModule("scipy.spatial")
+
+
+def build_tree(positions):
+    """
+    Build the k-d tree of one frame of particle positions.
+    """
+    return spatial.cKDTree(np.asarray(positions, dtype=np.float64))
+
+
+class ROI(ABC):
+    """
+    Abstract base class of a region of interest.
+    """
+    # regions tested point by point set this to False and override
+    # contains(), so no tree is built for them
+    needs_tree = True
+
+    @abstractmethod
+    def query(self, tree):
+        """
+        Return the sorted indices of the points of `tree` inside the region.
+        """
+        pass
+
+    def contains(self, positions):
+        """
+        Boolean mask of `positions` (N, 3) inside the region (no index).
+        """
+        mask = np.zeros(len(positions), dtype=bool)
+        mask[self.query(build_tree(positions))] = True
+        return mask
+
+
+class BoxROI(ROI):
+    """
+    Axis aligned box given by its lower and upper corners.
+    """
+    def __init__(self, lower, upper):
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper = np.asarray(upper, dtype=np.float64)
+
+    @classmethod
+    def from_bounds(cls, bounds):
+        """
+        Build from VTK style bounds (xmin, xmax, ymin, ymax, zmin, zmax).
+        """
+        return cls(bounds[::2], bounds[1::2])
+
+    def query(self, tree):
+        # Chebyshev ball around the centre covers the box, then trim
+        center = (self.lower + self.upper) / 2
+        radius = np.max(self.upper - self.lower) / 2
+        idx = np.asarray(
+            tree.query_ball_point(center, radius, p=np.inf), dtype=np.int64)
+        pts = tree.data[idx]
+        inside = np.all((pts >= self.lower) & (pts <= self.upper), axis=1)
+        return np.sort(idx[inside])
+
+
+class SphereROI(ROI):
+    def __init__(self, center, radius):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.radius = radius
+
+    def query(self, tree):
+        idx = tree.query_ball_point(self.center, self.radius)
+        return np.sort(np.asarray(idx, dtype=np.int64))
+
+
+class HalfSpaceROI(ROI):
+    """
+    Points on the side of the plane the normal points to, matching what
+    remains visible for a clip plane with the same origin and normal.
+    """
+    def __init__(self, origin, normal):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.normal = np.asarray(normal, dtype=np.float64)
+
+    needs_tree = False
+
+    def query(self, tree):
+        return np.nonzero(self.contains(tree.data))[0]
+
+    def contains(self, positions):
+        return (np.asarray(positions) - self.origin) @ self.normal >= 0
+
+
+class FieldROI(ROI):
+    """
+    Points where a scalar field lies in [low, high], e.g. particles within
+    a given distance of the pore wall:
+    FieldROI(pore_structure.wall_distance, high=5).
+    """
+    def __init__(self, field_fn, low=-np.inf, high=np.inf):
+        self.field_fn = field_fn
+        self.low = low
+        self.high = high
+
+    needs_tree = False
+
+    def query(self, tree):
+        return np.nonzero(self.contains(tree.data))[0]
+
+    def contains(self, positions):
+        values = self.field_fn(positions)
+        return (values >= self.low) & (values <= self.high)
+
+
+class FrustumROI(ROI):
+    """
+    Points inside every plane (a, b, c, d), i.e. ax + by + cz + d >= 0
+    with the normals pointing in, relaxed by `margin` world units.
+    """
+    def __init__(self, planes, margin=0.0):
+        planes = np.asarray(planes, dtype=np.float64).reshape(-1, 4)
+        self.planes = planes / np.linalg.norm(
+            planes[:, :3], axis=1, keepdims=True)
+        self.margin = margin
+
+    @classmethod
+    def from_camera(cls, camera, aspect, margin=0.0):
+        """
+        The side planes of a VTK camera's view frustum. Near and far are
+        left out: VTK resets them to the bounds of what is rendered.
+        """
+        planes = [0.0] * 24
+        camera.GetFrustumPlanes(aspect, planes)
+        return cls(np.reshape(planes, (6, 4))[:4], margin)
+
+    needs_tree = False
+
+    def query(self, tree):
+        return np.nonzero(self.contains(tree.data))[0]
+
+    def contains(self, positions):
+        side = np.asarray(positions) @ self.planes[:, :3].T \
+            + self.planes[:, 3]
+        return np.all(side >= -self.margin, axis=1)
+
+
+class IntersectionROI(ROI):
+    """
+    Points inside all of `rois` (None entries are ignored).
+    """
+    def __init__(self, *rois):
+        self.rois = [roi for roi in rois if roi is not None]
+        self.needs_tree = any(roi.needs_tree for roi in self.rois)
+
+    def contains(self, positions):
+        if self.needs_tree:
+            return super().contains(positions)
+        mask = np.ones(len(positions), dtype=bool)
+        for roi in self.rois:
+            mask &= roi.contains(positions)
+        return mask
+
+    def query(self, tree):
+        if not self.rois:
+            return np.arange(tree.n)
+        idx = self.rois[0].query(tree)
+        for roi in self.rois[1:]:
+            idx = np.intersect1d(idx, roi.query(tree), assume_unique=True)
+        return idx
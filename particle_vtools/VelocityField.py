@@ -0,0 +1,149 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+This file defines the Eulerian velocity field built from the Lagrangian
+particle samples.
+
+The entities are:
+- VelocityGrid
+"""
+import numpy as np
+
+from .utils import LazyModule, stream_ordered
+
+pv = LazyModule("pyvista")
+
+
+class VelocityGrid:
+    """
+    Regular grid accumulating particle velocities per cell (count, mean
+    vector and per-component variance). Samples are scattered with
+    np.bincount, so memory is bounded by the grid, not by the number of
+    frames accumulated.
+    """
+    def __init__(self, shape, spacing, origin=(0, 0, 0)):
+        self.shape = tuple(int(n) for n in shape)
+        self.spacing = np.broadcast_to(
+            np.asarray(spacing, dtype=np.float64), (3,)).copy()
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.reset()
+
+    @classmethod
+    def from_pore_structure(cls, pore_structure, down_sample_factor=None):
+        """
+        Grid covering the pore structure volume, in the same (scaled and
+        permuted) coordinates as its surface mesh. Cell k is centred on
+        the down sampled voxel k, which the mesh places at k * spacing.
+        """
+        if down_sample_factor is None:
+            down_sample_factor = pore_structure.down_sample_factor
+        shape = np.asarray(pore_structure.get_volume().shape)
+        scale = 1 if pore_structure.scale is None else pore_structure.scale
+        spacing = down_sample_factor * np.broadcast_to(
+            np.asarray(scale, dtype=np.float64), (3,))
+        if pore_structure.permute_axes:
+            shape = shape[list(pore_structure.permute_axes)]
+            spacing = spacing[list(pore_structure.permute_axes)]
+        shape = -(-shape // down_sample_factor)
+        return cls(shape, spacing, origin=-0.5 * spacing)
+
+    @staticmethod
+    def pore_mask(pore_structure, down_sample_factor=None, invert=False):
+        """
+        Boolean mask on the grid of from_pore_structure, True in the pore
+        space (voxels != threshold, or == threshold with `invert`).
+        """
+        if down_sample_factor is None:
+            down_sample_factor = pore_structure.down_sample_factor
+        step = down_sample_factor
+        volume = pore_structure.get_volume()[::step, ::step, ::step]
+        mask = volume == pore_structure.threshold
+        if not invert:
+            mask = ~mask
+        if pore_structure.permute_axes:
+            mask = np.transpose(mask, pore_structure.permute_axes)
+        return mask
+
+    def reset(self):
+        n_cells = int(np.prod(self.shape))
+        self.count = np.zeros(n_cells, dtype=np.int64)
+        self.sum = np.zeros((n_cells, 3), dtype=np.float64)
+        self.sum_sq = np.zeros((n_cells, 3), dtype=np.float64)
+
+    def cell_index(self, positions):
+        """
+        Flat cell index of each position, -1 outside the grid.
+        """
+        ijk = np.floor(
+            (np.asarray(positions) - self.origin) / self.spacing
+        ).astype(np.int64)
+        inside = np.all((ijk >= 0) & (ijk < self.shape), axis=1)
+        flat = np.full(len(ijk), -1, dtype=np.int64)
+        # x fastest, matching the VTK cell ordering of to_image
+        flat[inside] = np.ravel_multi_index(
+            ijk[inside].T, self.shape, order='F')
+        return flat
+
+    def accumulate(self, positions, velocities):
+        flat = self.cell_index(positions)
+        inside = flat >= 0
+        flat = flat[inside]
+        velocities = np.asarray(velocities, dtype=np.float64)[inside]
+        n_cells = len(self.count)
+        self.count += np.bincount(flat, minlength=n_cells)
+        for k in range(3):
+            self.sum[:, k] += np.bincount(
+                flat, weights=velocities[:, k], minlength=n_cells)
+            self.sum_sq[:, k] += np.bincount(
+                flat, weights=velocities[:, k] ** 2, minlength=n_cells)
+        return self
+
+    def accumulate_frames(self, particle_iterator, frames=None,
+                          read_ahead=4):
+        """
+        Stream the given frames (all by default) of a particle iterator
+        into the grid; frames are read by a worker thread, keeping
+        `read_ahead` of them ahead of the accumulation.
+        """
+        if frames is None:
+            frames = particle_iterator.get_frames()
+        for positions, velocities in stream_ordered(
+                particle_iterator.get_particle, frames, read_ahead,
+                n_workers=1):
+            self.accumulate(positions, velocities)
+        return self
+
+    def mean(self):
+        n = np.maximum(self.count, 1)[:, None]
+        return self.sum / n
+
+    def variance(self):
+        n = np.maximum(self.count, 1)[:, None]
+        mean = self.sum / n
+        return np.maximum(self.sum_sq / n - mean ** 2, 0)
+
+    def mean_grid(self):
+        """
+        Mean velocity as a (3, nx, ny, nz) array, for interpolation.
+        """
+        return self.mean().reshape(self.shape + (3,), order='F') \
+            .transpose(3, 0, 1, 2)
+
+    def to_image(self):
+        """
+        The field as a pyvista ImageData with cell arrays 'count',
+        'velocity' (mean vector), 'variance' and 'mags'.
+        """
+        image = pv.ImageData(
+            dimensions=np.asarray(self.shape) + 1,
+            spacing=self.spacing,
+            origin=self.origin)
+        mean = self.mean()
+        image.cell_data['count'] = self.count
+        image.cell_data['velocity'] = mean.astype(np.float32)
+        image.cell_data['variance'] = self.variance().astype(np.float32)
+        image.cell_data['mags'] = np.linalg.norm(
+            mean, axis=1).astype(np.float32)
+        image.set_active_scalars('mags')
+        return image
@@ -0,0 +1,63 @@
+"""
+Author Chunyang Wang
+Github: https://github.com/chunyang-w
+
+The particle_vtools package. Submodules and the main classes can be used
+from the package namespace, e.g. particle_vtools.Explorer3D.Explorer3D or
+particle_vtools.FluidIterator_CT; they are only imported when first
+accessed, so importing the package itself loads none of the heavy
+dependencies. Classes named like their module (Explorer3D, Playback,
+SliceViewer, PoreStructure, MaskSeries, SharedCache) are reached through
+the module, which is what the package attribute of that name is.
+"""
+import importlib
+
+_modules = [
+    "Analysis", "Comparison", "Explorer3D", "Export", "FluidStructure",
+    "Interpolation", "MaskSeries", "Particle", "Playback", "PoreStructure",
+    "Sampling", "SharedCache", "SliceViewer", "SpatialIndex", "Streamline",
+    "VelocityField", "utils",
+]
+
+# class name -> module defining it
+_exports = {
+    "LazyVolume": "SliceViewer",
+    "PVDExporter": "Export",
+    "PoreStructure_CT": "PoreStructure",
+    "FluidIterator": "FluidStructure",
+    "FluidIterator_CT": "FluidStructure",
+    "FluidIterator_Ganglion": "Analysis",
+    "FluidIterator_Interpolated": "Interpolation",
+    "ParticleIterator": "Particle",
+    "ParticleIterator_DF": "Particle",
+    "ParticleIterator_Interpolated": "Interpolation",
+    "MagnitudeStats": "Particle",
+    "FluidMetrics": "Analysis",
+    "GanglionTracker": "Analysis",
+    "ParticleComparison": "Comparison",
+    "StreamlineTracer": "Streamline",
+    "VelocityGrid": "VelocityField",
+    "BoxROI": "SpatialIndex",
+    "SphereROI": "SpatialIndex",
+    "HalfSpaceROI": "SpatialIndex",
+    "FieldROI": "SpatialIndex",
+    "FrustumROI": "SpatialIndex",
+    "IntersectionROI": "SpatialIndex",
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    if name in _modules:
+        return importlib.import_module(f"{__name__}.{name}")
+    if name not in _exports:
+        raise AttributeError(
+            f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f"{__name__}.{_exports[name]}")
+    return getattr(module, name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_modules))
+
@@ -1,31 +1,151 @@
+import importlib
+import threading
+
 import numpy as np
-import pyvista as pv
 
-from skimage import measure
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access, so
+    heavy dependencies (PyVista, pandas, scikit-image, SciPy) are only
+    loaded by the code that uses them - CLI tools and spawned worker
+    processes start faster.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+pv = LazyModule("pyvista")
+measure = LazyModule("skimage.measure")
 
 
 def tif_2_geo(tif_file, threshold=0, down_sample_factor=4):
     """
     Extract the geometry of the surface from a tif data.
+    Vertices are returned as float32 and faces as int32 (n_faces, 3).
     """
     # pad_width = 1
-    img = tif_file == threshold
+    # threshold the down sampled voxels only
+    step = down_sample_factor
+    img = tif_file[::step, ::step, ::step] == threshold
     # img = np.pad(img, pad_width=pad_width, mode='constant', constant_values=1)
-    img = img[::down_sample_factor, ::down_sample_factor, ::down_sample_factor]
-    verts, faces, _, _ = measure.marching_cubes(img, level=0.5)
+    return mask_2_geo(img, down_sample_factor)
+
+
+def mask_2_geo(mask, down_sample_factor=1):
+    """
+    Surface geometry of an already down sampled boolean mask (e.g.
+    MaskSeries.get_mask(index, step=down_sample_factor)), in the voxel
+    units of the full resolution volume.
+    """
+    verts, faces, _, _ = measure.marching_cubes(mask, level=0.5)
     # verts = verts - pad_width
-    verts = verts * down_sample_factor
+    # marching_cubes returns strided views; contiguous arrays are wrapped
+    # by the meshes without another copy (see geo_2_mesh)
+    verts = np.ascontiguousarray(verts, dtype=np.float32)
+    verts *= down_sample_factor
+    faces = np.ascontiguousarray(faces, dtype=np.int32)
     return verts, faces
 
 
+def faces_2_cells(faces):
+    """
+    Wrap an (n_faces, 3) triangle array into a VTK cell array.
+    int32 offsets/connectivity are used directly so no padded legacy
+    array (and no int64 copy) is built.
+    """
+    faces = np.ascontiguousarray(faces, dtype=np.int32)
+    offsets = np.arange(
+        0, faces.size + 1, faces.shape[1], dtype=np.int32)
+    return pv.CellArray.from_arrays(offsets, faces.ravel())
+
+
 def geo_2_mesh(verts, faces, smooth_iter=10, smooth_factor=0.5):
     """
     Convert the geometry to a pyvista mesh.
     then smooth the mesh - if necessary.
+    Without smoothing the mesh wraps `verts` and `faces` without copying,
+    so the caller must keep those arrays alive (and unchanged).
     """
-    faces_pv = np.hstack(
-        [np.full((faces.shape[0], 1), 3), faces]).astype(np.int64)
-    faces_pv = faces_pv.flatten()
-    mesh = pv.PolyData(var_inp=verts, faces=faces_pv)
-    mesh = mesh.smooth(n_iter=10, relaxation_factor=0.5)
+    mesh = pv.PolyData()
+    # assigning points (rather than PolyData(verts)) adds no vertex cells
+    mesh.points = np.asarray(verts, dtype=np.float32)
+    mesh.SetPolys(faces_2_cells(faces))
+    if smooth_iter:
+        mesh = mesh.smooth(n_iter=smooth_iter, relaxation_factor=smooth_factor)
     return mesh
+
+
+def swap_geometry(target, source):
+    """
+    Point `target` at the points, polygons and data arrays of `source`
+    in place. Only the VTK references are swapped (no data copy); VTK
+    reference counting keeps the buffers alive for as long as `target`
+    uses them.
+    """
+    target.SetPoints(source.GetPoints())
+    target.SetPolys(source.GetPolys())
+    target.GetPointData().ShallowCopy(source.GetPointData())
+    target.GetCellData().ShallowCopy(source.GetCellData())
+    target.Modified()
+    return target
+
+
+def tif_2_image(tif_file, down_sample_factor=4, scale=None,
+                permute_axes=None):
+    """
+    Down sampled label volume as a pyvista ImageData ('label' point
+    array) in the same coordinates as the surfaces of tif_2_geo.
+    """
+    step = down_sample_factor
+    labels = tif_file[::step, ::step, ::step]
+    spacing = np.full(3, float(step))
+    if scale:
+        spacing = spacing * scale
+    if permute_axes:
+        labels = np.transpose(labels, permute_axes)
+        spacing = spacing[list(permute_axes)]
+    image = pv.ImageData(dimensions=labels.shape, spacing=spacing)
+    # x fastest in VTK
+    image.point_data['label'] = labels.ravel(order='F')
+    return image
+
+
+def stream_ordered(load, items, read_ahead=4, n_workers=2):
+    """
+    Yield load(item) for `items` in order, loaded by worker threads ahead
+    of the consumer: while the consumer works on a result, the next
+    `read_ahead` items are loaded (or loading), so at most read_ahead + 1
+    results are held.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        pending = deque(
+            pool.submit(load, item)
+            for item in islice(items, max(read_ahead, 1)))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                # keep read_ahead items in flight while `result` is used
+                for item in items:
+                    pending.append(pool.submit(load, item))
+                    break
+                yield result
+                del result
+        finally:
+            # stopped early: drop what has not started
+            for future in pending:
+                future.cancel()